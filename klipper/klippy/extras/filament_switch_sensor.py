@@ -6,11 +6,891 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import logging
-import asyncio
+import logging, heapq, collections, re, math, array, struct, threading
+import os, queue
 
-from datetime import datetime
-import time
+# Trace levels and event codes
+TRACE_OFF, TRACE_ACTIONS, TRACE_EDGES = 0, 1, 2
+(EV_EDGE, EV_DEBOUNCE, EV_CHECK, EV_RECHECK, EV_FILLEDUP, EV_RUNOUT,
+ EV_EMERGENCY) = range(7)
+EVENT_NAMES = ["edge", "debounce", "check", "recheck", "filledup", "runout",
+               "emergency"]
+
+# Preallocated ring buffer of (eventtime, state, event) debug records
+class PelletTrace:
+    def __init__(self, config):
+        self.level = config.getint('trace_level', TRACE_ACTIONS,
+                                   minval=TRACE_OFF, maxval=TRACE_EDGES)
+        self.size = config.getint('trace_size', 256, minval=1)
+        self.times = [0.] * self.size
+        self.states = [None] * self.size
+        self.events = [0] * self.size
+        self.pos = self.count = 0
+    def record(self, level, eventtime, state, event):
+        if level > self.level:
+            return
+        pos = self.pos
+        self.times[pos] = eventtime
+        self.states[pos] = state
+        self.events[pos] = event
+        pos += 1
+        if pos >= self.size:
+            pos = 0
+        self.pos = pos
+        if self.count < self.size:
+            self.count += 1
+    def clear(self):
+        self.pos = self.count = 0
+    def format(self, count=None):
+        if count is None or count > self.count:
+            count = self.count
+        lines = []
+        for i in range(self.count - count, self.count):
+            pos = (self.pos - self.count + i) % self.size
+            lines.append("%.3f %s state=%s" % (
+                self.times[pos], EVENT_NAMES[self.events[pos]],
+                self.states[pos]))
+        return lines
+
+# History codes, packed with the sensor state in a single byte
+(HIST_STATE, HIST_RUNOUT, HIST_FILLEDUP, HIST_EMERGENCY,
+ HIST_SUPPRESSED) = range(5)
+HISTORY_NAMES = ["state", "runout", "filledup", "emergency", "suppressed"]
+HISTORY_STATES = {False: 0, True: 1, None: 2}
+HISTORY_STATE_NAMES = [False, True, None]
+
+# Fixed size history of the sensor states and feeder actions, kept in
+# arrays (9 bytes per record) so that hours of history fit in a few KB
+class PelletHistory:
+    def __init__(self, config):
+        self.size = config.getint('history_size', 1024, minval=1)
+        self.times = array.array('d', [0.]) * self.size
+        self.codes = array.array('B', [0]) * self.size
+        self.pos = self.count = 0
+        self.telemetry = None
+        self.sensor_id = 0
+    def record(self, eventtime, state, code):
+        if self.telemetry is not None:
+            self.telemetry.record(eventtime, self.sensor_id, state, code)
+        pos = self.pos
+        self.times[pos] = eventtime
+        self.codes[pos] = (code << 2) | HISTORY_STATES[state]
+        pos += 1
+        if pos >= self.size:
+            pos = 0
+        self.pos = pos
+        if self.count < self.size:
+            self.count += 1
+    def get_records(self, count=None):
+        if count is None or count > self.count:
+            count = self.count
+        records = []
+        for i in range(self.count - count, self.count):
+            pos = (self.pos - self.count + i) % self.size
+            code = self.codes[pos]
+            records.append((self.times[pos], HISTORY_NAMES[code >> 2],
+                            HISTORY_STATE_NAMES[code & 0x03]))
+        return records
+
+# Telemetry records: eventtime, sensor id, raw state and decision, where
+# the decision is one of the history codes or TELEMETRY_EDGE for a raw edge
+TELEMETRY_RECORD = struct.Struct('<dHBB')
+TELEMETRY_EDGE = len(HISTORY_NAMES)
+TELEMETRY_NAMES = HISTORY_NAMES + ["edge"]
+TELEMETRY_FLUSH_TIME = 1.
+
+# Append-only binary log of the sensor events. Records are packed in a
+# buffer from the reactor and written to the file by a background thread.
+class PelletTelemetry:
+    def __init__(self, printer, filename):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.filename = filename
+        self.sensor_names = []
+        self.buffer = bytearray()
+        self.queue = queue.Queue()
+        self.thread = None
+        # Set once the file can not be written, records are then dropped
+        self.failed = False
+        self.flush_timer = self.reactor.register_timer(self._flush_event)
+        printer.register_event_handler("klippy:connect", self._handle_connect)
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
+    def register_sensor(self, name):
+        self.sensor_names.append(name)
+        return len(self.sensor_names) - 1
+    def _handle_connect(self):
+        # The sensor ids of this session are appended next to the log,
+        # after a marker with the index of the first record of the session
+        fd = None
+        try:
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            first = os.fstat(fd).st_size // TELEMETRY_RECORD.size
+            with open(self.filename + ".sensors", "a") as f:
+                f.write("session %d\n" % (first,))
+                f.write("".join("%s\n" % (name,)
+                                for name in self.sensor_names))
+        except (IOError, OSError):
+            logging.exception("Unable to open pellet telemetry file %s",
+                              self.filename)
+            if fd is not None:
+                os.close(fd)
+            self._stop_recording()
+            return
+        self.thread = threading.Thread(target=self._writer_thread,
+                                       args=(fd,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
+    def _handle_disconnect(self):
+        if self.thread is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.reactor.update_timer(self.flush_timer, self.reactor.NEVER)
+    def _stop_recording(self):
+        self.failed = True
+        del self.buffer[:]
+    def _writer_thread(self, fd):
+        # After a write error the queue is still drained until the end
+        try:
+            while 1:
+                data = self.queue.get()
+                if data is None:
+                    break
+                if self.failed:
+                    continue
+                try:
+                    os.write(fd, data)
+                except OSError:
+                    logging.exception("Error writing pellet telemetry file"
+                                      " %s, telemetry stopped", self.filename)
+                    self.failed = True
+        finally:
+            os.close(fd)
+    def record(self, eventtime, sensor_id, state, decision):
+        if self.failed:
+            return
+        self.buffer += TELEMETRY_RECORD.pack(
+            eventtime, sensor_id, HISTORY_STATES[state], decision)
+    def flush(self):
+        if self.failed:
+            del self.buffer[:]
+        elif self.buffer and self.thread is not None:
+            self.queue.put(bytes(self.buffer))
+            del self.buffer[:]
+    def _flush_event(self, eventtime):
+        self.flush()
+        if self.failed:
+            return self.reactor.NEVER
+        return eventtime + TELEMETRY_FLUSH_TIME
+
+# Majority vote with hysteresis over the last window_samples samples of
+# the pin. The pin level is sampled every sample_time seconds, rebuilt
+# from the edge timestamps, and the samples are packed in an integer.
+class MajorityFilter:
+    def __init__(self, config, window_time):
+        self.samples = config.getint('window_samples', 16, minval=2,
+                                     maxval=64)
+        self.high_threshold = config.getint(
+            'high_threshold', (self.samples * 3) // 4, minval=1,
+            maxval=self.samples)
+        self.low_threshold = config.getint(
+            'low_threshold', self.samples // 4, minval=0,
+            maxval=self.samples - 1)
+        if self.low_threshold >= self.high_threshold:
+            raise config.error(
+                "low_threshold must be below high_threshold in section '%s'"
+                % (config.get_name(),))
+        self.window_time = window_time
+        self.sample_time = window_time / self.samples
+        self.mask = (1 << self.samples) - 1
+        # Bit i of history is the pin level i samples ago
+        self.history = self.count = self.valid = 0
+        self.level = None
+        self.last_sample_time = 0.
+        self.state = None
+    def _shift(self, nsamples):
+        if nsamples >= self.samples:
+            self.history = self.mask if self.level else 0
+            self.count = self.samples if self.level else 0
+            self.valid = self.samples
+            return
+        dropped = self.history >> (self.samples - nsamples)
+        self.count -= bin(dropped).count('1')
+        self.history = (self.history << nsamples) & self.mask
+        if self.level:
+            self.history |= (1 << nsamples) - 1
+            self.count += nsamples
+        self.valid = min(self.valid + nsamples, self.samples)
+    def _update_state(self):
+        if self.valid < self.samples:
+            return self.state
+        if self.count >= self.high_threshold:
+            self.state = True
+        elif self.count <= self.low_threshold:
+            self.state = False
+        return self.state
+    def update(self, eventtime, level):
+        if self.level is not None:
+            nsamples = int((eventtime - self.last_sample_time)
+                           / self.sample_time)
+            if nsamples:
+                self._shift(nsamples)
+                self.last_sample_time += nsamples * self.sample_time
+        else:
+            self.last_sample_time = eventtime
+        self.level = level
+        return self._update_state()
+    def flush(self):
+        # The pin has kept its level for a whole window
+        if self.level is not None:
+            self._shift(self.samples)
+        return self._update_state()
+
+# Edge storm detection: once more than storm_rate edges per second arrive
+# in a storm_window, the edges are coalesced into a single pending sample
+# that is handed over at the end of each window until the rate drops.
+class EdgeStormFilter:
+    def __init__(self, config):
+        self.rate = config.getfloat('storm_rate', 0., minval=0.)
+        self.window = config.getfloat('storm_window', 1., above=0.)
+        self.warning = config.getboolean('storm_warning', True)
+        self.max_edges = self.rate * self.window
+        self.window_start = 0.
+        self.window_count = 0
+        self.storming = False
+        self.pending_state = self.pending_time = None
+        self.storm_count = self.coalesced_count = 0
+    def note_edge(self, eventtime, state):
+        if eventtime - self.window_start >= self.window:
+            self.window_start = eventtime
+            self.window_count = 0
+        self.window_count += 1
+        if not self.storming:
+            if self.window_count <= self.max_edges:
+                return True
+            self.storming = True
+            self.storm_count += 1
+        self.pending_state = state
+        self.pending_time = eventtime
+        self.coalesced_count += 1
+        return False
+    def get_window_end(self):
+        return self.window_start + self.window
+    def flush(self, eventtime):
+        # Returns the coalesced sample, if any, and ends the storm once a
+        # whole window stayed below the rate
+        if self.window_count <= self.max_edges:
+            self.storming = False
+        self.window_start = eventtime
+        self.window_count = 0
+        state, edge_time = self.pending_state, self.pending_time
+        self.pending_state = self.pending_time = None
+        return state, edge_time
+
+# Debounce auto-tuning. The time between two edges shorter than
+# autotune_max_debounce is taken as a bounce, kept in a histogram with
+# logarithmic bins. A bounce lasting at least the debounce window would be
+# acted on as a switch, so the tuned window is the shortest one that keeps
+# those spurious switches below autotune_target_rate per hour observed.
+AUTOTUNE_BINS = 40
+
+class DebounceTuner:
+    def __init__(self, config):
+        self.min_debounce = config.getfloat('autotune_min_debounce', 0.05,
+                                            above=0.)
+        self.max_debounce = config.getfloat('autotune_max_debounce', 2.,
+                                            above=self.min_debounce)
+        self.target_rate = config.getfloat('autotune_target_rate', 1.,
+                                           minval=0.)
+        self.interval = config.getfloat('autotune_interval', 0., minval=0.)
+        self.min_time = config.getfloat('autotune_min_time', 600., minval=0.)
+        self.min_bounces = config.getint('autotune_min_bounces', 20,
+                                         minval=1)
+        self.bin_ratio = (math.log(self.max_debounce / self.min_debounce)
+                          / AUTOTUNE_BINS)
+        self.counts = array.array('I', [0]) * AUTOTUNE_BINS
+        self.start_time = self.last_edge_time = None
+        self.bounce_count = 0
+    def note_edge(self, eventtime):
+        last_edge_time = self.last_edge_time
+        self.last_edge_time = eventtime
+        if last_edge_time is None:
+            self.start_time = eventtime
+            return
+        interval = eventtime - last_edge_time
+        if interval >= self.max_debounce:
+            return
+        pos = 0
+        if interval > self.min_debounce:
+            pos = min(AUTOTUNE_BINS - 1, int(
+                math.log(interval / self.min_debounce) / self.bin_ratio))
+        self.counts[pos] += 1
+        self.bounce_count += 1
+    def get_observed_time(self, eventtime):
+        if self.start_time is None:
+            return 0.
+        return eventtime - self.start_time
+    def has_data(self, eventtime):
+        return (self.bounce_count >= self.min_bounces
+                and self.get_observed_time(eventtime) >= self.min_time)
+    def tune(self, eventtime):
+        # Returns the debounce window and its spurious switches per hour,
+        # or None until enough bounces have been observed
+        if not self.has_data(eventtime):
+            return None
+        hours = self.get_observed_time(eventtime) / 3600.
+        allowed = self.target_rate * hours
+        pos = AUTOTUNE_BINS
+        spurious = 0
+        while pos and spurious + self.counts[pos - 1] <= allowed:
+            pos -= 1
+            spurious += self.counts[pos]
+        debounce_time = self.min_debounce * math.exp(pos * self.bin_ratio)
+        return debounce_time, spurious / hours
+
+# Predictive feeding. The extruder position is sampled to estimate the
+# pellet consumption rate (in mm of extrusion per second). The refills
+# teach how much extrusion a hopper lasts from a filledup to the next trip
+# of the sensor (buffer), and how fast the feeder refills it (fill_rate,
+# from the extrusion between two filledups over the feeder on time, as the
+# hopper is in the same state at both). The feeder is started lead_time
+# before the hopper is predicted to trip the sensor, for as long as it
+# needs to replace what was used.
+PREDICT_LEARN_RATE = 0.3
+
+class FeederPredictor:
+    def __init__(self, config):
+        self.lead_time = config.getfloat('predict_lead_time', 2., minval=0.)
+        self.interval = config.getfloat('predict_interval', .5, above=0.)
+        self.smooth_time = config.getfloat('predict_smooth_time', 5.,
+                                           above=0.)
+        # Highest extruder position seen, unretracts only restore filament
+        # that was already counted
+        self.max_e = self.last_time = None
+        self.e_total = 0.
+        self.rate = 0.
+        self.buffer = self.fill_rate = None
+        # e_total at the end of the last refill, None when unknown
+        self.full_e = None
+        # e_total and feeder on time since the last filledup
+        self.filledup_e = None
+        self.on_time = 0.
+        self.feed_start_time = None
+        self.feed_deficit = 0.
+        self.prefeed_end = None
+    def _learn(self, old, value):
+        if old is None:
+            return value
+        return old + PREDICT_LEARN_RATE * (value - old)
+    def sample(self, eventtime, e_pos):
+        if self.max_e is None:
+            self.max_e, self.last_time = e_pos, eventtime
+            return
+        de = max(0., e_pos - self.max_e)
+        self.e_total += de
+        self.max_e = max(self.max_e, e_pos)
+        dt = eventtime - self.last_time
+        if dt > 0.:
+            alpha = dt / (dt + self.smooth_time)
+            self.rate += alpha * (de / dt - self.rate)
+            self.last_time = eventtime
+    def get_used(self):
+        if self.full_e is None:
+            return None
+        return self.e_total - self.full_e
+    def note_empty(self):
+        used = self.get_used()
+        if used is not None:
+            if self.prefeed_end is not None:
+                # Tripped while prefeeding: the hopper lasted less than
+                # predicted when the prefeed started
+                used = self.feed_deficit
+            self.buffer = self._learn(self.buffer, used)
+        self.full_e = None
+    def note_feeder_on(self, eventtime):
+        self.feed_start_time = eventtime
+        self.feed_deficit = self.get_used()
+    def note_feeder_off(self, eventtime, filledup):
+        if self.feed_start_time is None:
+            # The feeder was not on, nothing was refilled
+            return
+        self.on_time += eventtime - self.feed_start_time
+        if filledup:
+            if self.filledup_e is not None and self.on_time > 0.:
+                self.fill_rate = self._learn(
+                    self.fill_rate,
+                    (self.e_total - self.filledup_e) / self.on_time)
+            self.filledup_e = self.e_total
+            self.on_time = 0.
+        self.full_e = self.e_total
+        self.feed_start_time = self.prefeed_end = None
+    def get_time_to_empty(self):
+        used = self.get_used()
+        if used is None or self.buffer is None or self.rate <= 0.:
+            return None
+        return max(0., self.buffer - used) / self.rate
+    def check_prefeed(self):
+        if (self.fill_rate is None or self.buffer is None
+            or self.prefeed_end is not None
+            or self.buffer < 2. * self.lead_time * self.rate):
+            # A hopper lasting less than twice the lead time is left to
+            # the sensor
+            return False
+        time_to_empty = self.get_time_to_empty()
+        return time_to_empty is not None and time_to_empty <= self.lead_time
+    def start_prefeed(self, eventtime, never):
+        # Replace what was used, plus what is used while feeding. A feeder
+        # slower than the extruder is left on until the sensor trips.
+        self.note_feeder_on(eventtime)
+        self.prefeed_end = never
+        if self.fill_rate > self.rate:
+            self.prefeed_end = eventtime + (self.feed_deficit
+                                            / (self.fill_rate - self.rate))
+    def get_next_sample_time(self, eventtime):
+        # Wake up on time for the end of a prefeed or the next one
+        waketime = eventtime + self.interval
+        if self.prefeed_end is not None:
+            if self.prefeed_end > eventtime:
+                waketime = min(waketime, self.prefeed_end)
+            return waketime
+        time_to_empty = self.get_time_to_empty()
+        if time_to_empty is not None and time_to_empty > self.lead_time:
+            delay = max(time_to_empty - self.lead_time, .1 * self.interval)
+            waketime = min(waketime, eventtime + delay)
+        return waketime
+    def get_status(self, eventtime):
+        return {'consumption_rate': self.rate, 'buffer': self.buffer,
+                'fill_rate': self.fill_rate,
+                'time_to_empty': self.get_time_to_empty(),
+                'prefeeding': self.prefeed_end is not None}
+
+# Staged escalation of a runout that lasts: a warning, then the speed
+# factor is lowered step by step, and the print is paused only as a last
+# resort. All the stages are timed from the runout.
+class RunoutEscalation:
+    def __init__(self, config, pause):
+        self.warn_time = config.getfloat('escalation_warn_time', 5.,
+                                         minval=0.)
+        self.throttle_time = config.getfloat('escalation_throttle_time', 10.,
+                                             minval=0.)
+        self.throttle_interval = config.getfloat(
+            'escalation_throttle_interval', 5., above=0.)
+        self.throttle_step = config.getfloat('escalation_throttle_step', 10.,
+                                             above=0., maxval=100.)
+        self.min_speed = config.getfloat('escalation_min_speed', 50.,
+                                         above=0., maxval=100.)
+        self.max_steps = int(math.ceil((100. - self.min_speed)
+                                       / self.throttle_step))
+        self.pause_time = None
+        if pause:
+            self.pause_time = config.getfloat('escalation_pause_time', 60.,
+                                              minval=0.)
+        self.start_time = None
+        self.warned = self.paused = False
+        self.steps = 0
+        self.orig_speed = 100.
+    def start(self, eventtime, orig_speed):
+        self.start_time = eventtime
+        self.warned = self.paused = False
+        self.steps = 0
+        self.orig_speed = orig_speed
+    def stop(self):
+        self.start_time = None
+    # The stages are taken on the same absolute deadlines the timer is
+    # woken for, so that rounding never leaves a deadline without a stage
+    def get_warn_time(self):
+        return self.start_time + self.warn_time
+    def get_step_time(self, steps):
+        return (self.start_time + self.throttle_time
+                + steps * self.throttle_interval)
+    def get_pause_time(self):
+        return self.start_time + self.pause_time
+    def get_throttle_steps(self, eventtime):
+        steps = self.steps
+        while steps < self.max_steps and eventtime >= self.get_step_time(steps):
+            steps += 1
+        return steps
+    def get_speed(self):
+        # Speed factor, in percent, after the steps taken so far
+        percent = max(self.min_speed, 100. - self.steps * self.throttle_step)
+        return self.orig_speed * percent / 100.
+    def get_next_time(self, never):
+        waketime = never
+        if not self.warned:
+            waketime = min(waketime, self.get_warn_time())
+        if self.steps < self.max_steps:
+            waketime = min(waketime, self.get_step_time(self.steps))
+        if self.pause_time is not None and not self.paused:
+            waketime = min(waketime, self.get_pause_time())
+        return waketime
+    def get_stage(self):
+        if self.start_time is None:
+            return "none"
+        if self.paused:
+            return "pause"
+        if self.steps:
+            return "throttle"
+        if self.warned:
+            return "warn"
+        return "runout"
+
+# Rendered scripts of a gcode template. A template without any '{' is
+# static and never rendered again. A dynamic template that only reads
+# printer objects is rendered again only when their status changes.
+class CachedTemplate:
+    printer_r = re.compile(r"\bprinter\b")
+    # printer.<object>.<field>, with either part also as ['...'], and not
+    # followed by a call
+    field_r = re.compile(
+        r"\bprinter\s*(?:\.\s*(\w+)|\[\s*['\"]([^'\"]+)['\"]\s*\])"
+        r"\s*(?:\.\s*(\w+)|\[\s*['\"]([^'\"]+)['\"]\s*\])(?!\s*[\w(])")
+    def __init__(self, printer, template, script):
+        self.printer = printer
+        self.template = template
+        self.is_static = '{' not in script
+        # (object, field) pairs the script reads, None when the script may
+        # use the printer state in other ways
+        self.fields = None
+        if not self.is_static and 'action_' not in script:
+            fields = [(a or b, c or d)
+                      for a, b, c, d in self.field_r.findall(script)]
+            if len(fields) == len(self.printer_r.findall(script)):
+                self.fields = sorted(set(fields))
+        self.objects = None
+        self.scripts = {}
+        self.render_key = self.rendered = None
+    def _get_render_key(self, eventtime):
+        # Only the fields the script reads: whole status dicts hold values,
+        # like estimated_print_time, that change on every call
+        if self.objects is None:
+            self.objects = {}
+            for name, field in self.fields:
+                obj = self.printer.lookup_object(name, None)
+                if obj is not None and hasattr(obj, 'get_status'):
+                    self.objects[name] = obj
+        statuses = {name: obj.get_status(eventtime)
+                    for name, obj in self.objects.items()}
+        return tuple([repr(statuses[name].get(field))
+                      for name, field in self.fields if name in statuses])
+    def get_script(self, prefix, eventtime):
+        if self.is_static:
+            if self.rendered is None:
+                self.rendered = self.template.render()
+        elif self.fields is None:
+            return prefix + self.template.render() + "\nM400"
+        else:
+            key = self._get_render_key(eventtime)
+            if key != self.render_key:
+                self.rendered = self.template.render()
+                self.render_key = key
+                self.scripts.clear()
+        script = self.scripts.get(prefix)
+        if script is None:
+            script = self.scripts[prefix] = prefix + self.rendered + "\nM400"
+        return script
+
+PIN_MIN_TIME = 0.100
+STATUS_REFRESH_TIME = 1.
+PAUSE_DELAY = 0.5
+
+# Feeder relay on rele_pin, switched through the mcu command queue
+class FeederRelay:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        ppins = self.printer.lookup_object('pins')
+        self.mcu_pin = ppins.setup_pin('digital_out', config.get('rele_pin'))
+        self.mcu_pin.setup_max_duration(0.)
+        self.mcu_pin.setup_start_value(0., 0.)
+        self.mcu = self.mcu_pin.get_mcu()
+        self.value = 0
+        self.last_print_time = 0.
+    def set_feeder(self, eventtime, value):
+        value = 1 if value else 0
+        if value == self.value:
+            return False
+        print_time = self.mcu.estimated_print_time(eventtime) + PIN_MIN_TIME
+        print_time = max(print_time, self.last_print_time + PIN_MIN_TIME)
+        self.mcu_pin.set_digital(print_time, value)
+        self.value = value
+        self.last_print_time = print_time
+        return True
+    def pulse(self, eventtime, on_time):
+        # Queue a whole pulse: the off edge is scheduled ahead on the mcu
+        print_time = self.mcu.estimated_print_time(eventtime) + PIN_MIN_TIME
+        print_time = max(print_time, self.last_print_time + PIN_MIN_TIME)
+        if not self.value:
+            self.mcu_pin.set_digital(print_time, 1)
+        off_time = print_time + max(on_time, PIN_MIN_TIME)
+        self.mcu_pin.set_digital(off_time, 0)
+        self.value = 0
+        self.last_print_time = off_time
+
+PULSE_LEARN_RATE = 0.5
+
+# Pulsed feeder drive: while the hopper is empty the relay is switched on
+# for duty * pulse_period every pulse_period, with the duty adapted so
+# that a refill takes about pulse_refill_time
+class FeederPulser:
+    def __init__(self, config):
+        self.period = config.getfloat('pulse_period', 2.,
+                                      minval=4. * PIN_MIN_TIME)
+        self.min_duty = config.getfloat('pulse_min_duty', 0.2,
+                                        minval=2. * PIN_MIN_TIME / self.period,
+                                        maxval=1.)
+        self.duty = config.getfloat('pulse_duty', 0.5, minval=self.min_duty,
+                                    maxval=1.)
+        self.refill_time = config.getfloat('pulse_refill_time', 10., above=0.)
+        self.start_time = None
+        self.start_duty = self.duty
+        self.pulse_count = 0
+    def start(self, eventtime):
+        if self.start_time is None:
+            self.start_time = eventtime
+            self.start_duty = self.duty
+    def _adapt(self, eventtime):
+        # A slow refill raises the duty, a quick one lowers it
+        ratio = (eventtime - self.start_time) / self.refill_time
+        duty = self.start_duty * (1. + PULSE_LEARN_RATE * (ratio - 1.))
+        return min(1., max(self.min_duty, duty))
+    def stop(self, eventtime, filledup):
+        if self.start_time is None:
+            return
+        if filledup:
+            self.duty = self._adapt(eventtime)
+        self.start_time = None
+    def next_pulse(self, eventtime):
+        # The duty already rises during a refill that lasts too long
+        self.duty = max(self.duty, self._adapt(eventtime))
+        self.pulse_count += 1
+        return self.duty * self.period
+    def get_status(self):
+        return {'duty': self.duty, 'pulses': self.pulse_count}
+
+# Minimum on/off time and maximum switch rate of the feeder
+class FeederRateLimiter:
+    def __init__(self, config):
+        self.min_on_time = config.getfloat('min_on_time', 0., minval=0.)
+        self.min_off_time = config.getfloat('min_off_time', 0., minval=0.)
+        self.max_switches = config.getint('max_switches_per_minute', 0,
+                                          minval=0)
+        self.switch_times = None
+        if self.max_switches:
+            self.switch_times = collections.deque(maxlen=self.max_switches)
+        self.feeder_on = False
+        self.last_switch_time = None
+        self.switch_count = self.suppressed_count = 0
+    def next_switch_time(self, eventtime, feeder_on):
+        # Earliest time at which the feeder may be switched to feeder_on
+        if feeder_on == self.feeder_on:
+            return eventtime
+        waketime = eventtime
+        if self.last_switch_time is not None:
+            if feeder_on:
+                min_time = self.min_off_time
+            else:
+                min_time = self.min_on_time
+            waketime = max(waketime, self.last_switch_time + min_time)
+        switch_times = self.switch_times
+        if switch_times is not None and len(switch_times) == self.max_switches:
+            waketime = max(waketime, switch_times[0] + 60.)
+        return waketime
+    def note_switch(self, eventtime, feeder_on):
+        if feeder_on == self.feeder_on:
+            return False
+        self.feeder_on = feeder_on
+        self.last_switch_time = eventtime
+        self.switch_count += 1
+        if self.switch_times is not None:
+            self.switch_times.append(eventtime)
+        return True
+
+# Running mean/variance (Welford), minimum and maximum of a sample
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = self.m2 = 0.
+        self.min = self.max = None
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    def get_status(self):
+        stddev = 0.
+        if self.count > 1:
+            stddev = math.sqrt(self.m2 / (self.count - 1))
+        return {'count': self.count, 'mean': self.mean, 'stddev': stddev,
+                'min': self.min, 'max': self.max}
+
+# Hopper statistics, all updated in O(1) per event
+class HopperStats:
+    EDGE_RATE_TIME = 60.
+    def __init__(self, eventtime):
+        self.refill_time = RunningStats()
+        self.empty_time = RunningStats()
+        self.start_time = eventtime
+        self.feeder_on_time = 0.
+        self.feeder_on_since = self.empty_since = None
+        self.edge_count = 0
+        self.edge_rate = 0.
+        self.last_edge_time = eventtime
+    def note_edge(self, eventtime):
+        # Exponentially decaying rate with a EDGE_RATE_TIME time constant
+        self.edge_count += 1
+        decay = math.exp(-max(0., eventtime - self.last_edge_time)
+                         / self.EDGE_RATE_TIME)
+        self.edge_rate = self.edge_rate * decay + 1. / self.EDGE_RATE_TIME
+        self.last_edge_time = eventtime
+    def note_runout(self, eventtime):
+        # Empty periods follow the debounced decisions, from the edge that
+        # started a runout to the edge that ended it
+        if self.empty_since is None:
+            self.empty_since = eventtime
+    def note_filledup(self, eventtime, filledup):
+        # The feeder is also switched off with the hopper still empty (end
+        # of a print, sensor disabled), which ends no empty period
+        if filledup and self.empty_since is not None:
+            self.empty_time.add(eventtime - self.empty_since)
+        self.empty_since = None
+    def note_feeder(self, eventtime, feeder_on):
+        if feeder_on:
+            self.feeder_on_since = eventtime
+        elif self.feeder_on_since is not None:
+            duration = eventtime - self.feeder_on_since
+            self.refill_time.add(duration)
+            self.feeder_on_time += duration
+            self.feeder_on_since = None
+    def get_status(self, eventtime):
+        on_time = self.feeder_on_time
+        if self.feeder_on_since is not None:
+            on_time += max(0., eventtime - self.feeder_on_since)
+        elapsed = eventtime - self.start_time
+        duty_cycle = 0.
+        if elapsed > 0.:
+            duty_cycle = min(1., on_time / elapsed)
+        decay = math.exp(-max(0., eventtime - self.last_edge_time)
+                         / self.EDGE_RATE_TIME)
+        return {'refill_time': self.refill_time.get_status(),
+                'empty_time': self.empty_time.get_status(),
+                'feeder_duty_cycle': duty_cycle,
+                'edge_count': self.edge_count,
+                'edge_rate': self.edge_rate * decay}
+
+# A deadline serviced by the PelletSensorManager timer
+class PelletDeadline:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+        self.seq = 0
+
+# Owner of all pellet sensors. The debounce and emergency deadlines of
+# every sensor are kept in a heap and serviced by one reactor timer.
+class PelletSensorManager:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.sensors = {}
+        self.telemetry = {}
+        self.sensor_status = {}
+        self.status = None
+        self.heap = []
+        self.pending = 0
+        self.seq = 0
+        self.next_waketime = self.reactor.NEVER
+        self.timer = self.reactor.register_timer(self._handle_timer)
+    def register_sensor(self, runout_helper):
+        self.sensors[runout_helper.name] = runout_helper
+    def lookup_telemetry(self, filename):
+        # Sensors logging to the same file share the writer
+        filename = os.path.abspath(os.path.expanduser(filename))
+        if filename not in self.telemetry:
+            self.telemetry[filename] = PelletTelemetry(self.printer, filename)
+        return self.telemetry[filename]
+    def register_deadline(self, callback, waketime=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        deadline = PelletDeadline(callback, self.reactor.NEVER)
+        self.update_deadline(deadline, waketime)
+        return deadline
+    def update_deadline(self, deadline, waketime):
+        if deadline.waketime != self.reactor.NEVER:
+            self.pending -= 1
+        deadline.waketime = waketime
+        if waketime == self.reactor.NEVER:
+            return
+        # Old heap entries of this deadline become stale (seq mismatch)
+        self.pending += 1
+        self.seq += 1
+        deadline.seq = self.seq
+        heapq.heappush(self.heap, (waketime, self.seq, deadline))
+        if len(self.heap) > 2 * self.pending + 64:
+            self.heap[:] = [e for e in self.heap if e[1] == e[2].seq
+                            and e[0] == e[2].waketime]
+            heapq.heapify(self.heap)
+        if waketime < self.next_waketime:
+            self.next_waketime = waketime
+            self.reactor.update_timer(self.timer, waketime)
+    def _handle_timer(self, eventtime):
+        heap = self.heap
+        # A deadline that asks to run again at or before eventtime is only
+        # run again on the next pass, a callback can not loop forever
+        again = []
+        while heap:
+            waketime, seq, deadline = heap[0]
+            if seq != deadline.seq or waketime != deadline.waketime:
+                heapq.heappop(heap)
+                continue
+            if waketime > eventtime:
+                break
+            heapq.heappop(heap)
+            self.pending -= 1
+            deadline.waketime = self.reactor.NEVER
+            waketime = deadline.callback(eventtime)
+            if waketime <= eventtime:
+                again.append((deadline, waketime))
+                continue
+            self.update_deadline(deadline, waketime)
+        for deadline, waketime in again:
+            if deadline.waketime == self.reactor.NEVER:
+                self.update_deadline(deadline, waketime)
+        if heap:
+            self.next_waketime = heap[0][0]
+        else:
+            self.next_waketime = self.reactor.NEVER
+        return self.next_waketime
+    def get_status(self, eventtime):
+        # Rebuild only when one of the sensors published a new status
+        changed = self.status is None
+        sensors = self.sensor_status
+        for name, helper in self.sensors.items():
+            status = helper.get_status(eventtime)
+            if sensors.get(name) is not status:
+                sensors[name] = status
+                changed = True
+        if changed:
+            self.status = {
+                "sensors": dict(sensors),
+                "empty": [name for name, helper in self.sensors.items()
+                          if helper.pellet_present is False],
+                "feeding": [name for name, helper in self.sensors.items()
+                            if helper.rate_limiter.feeder_on]}
+        return self.status
+
+def lookup_pellet_sensor_manager(printer):
+    manager = printer.lookup_object('pellet_sensors', None)
+    if manager is None:
+        manager = PelletSensorManager(printer)
+        printer.add_object('pellet_sensors', manager)
+    return manager
 
 class RunoutHelper:
     def __init__(self, config):
@@ -23,31 +903,116 @@ class RunoutHelper:
         self.runout_pause = config.getboolean('pause_on_runout', False)
         if self.runout_pause:
             self.printer.load_object(config, 'pause_resume')
-        self.runout_gcode = self.filledup_gcode = None
+        self.runout_gcode = self.filledup_gcode = self.emergency_gcode = None
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         if self.runout_pause or config.get('runout_gcode', None) is not None:
-            self.runout_gcode = gcode_macro.load_template(
-                config, 'runout_gcode', '')
+            self.runout_gcode = CachedTemplate(
+                self.printer,
+                gcode_macro.load_template(config, 'runout_gcode', ''),
+                config.get('runout_gcode', ''))
         if config.get('filledup_gcode', None) is not None:
-            self.filledup_gcode = gcode_macro.load_template(
-                config, 'filledup_gcode')
+            self.filledup_gcode = CachedTemplate(
+                self.printer,
+                gcode_macro.load_template(config, 'filledup_gcode'),
+                config.get('filledup_gcode'))
         if config.get('emergency_gcode', None) is not None:
-            self.emergency_gcode = gcode_macro.load_template(
-                config, 'emergency_gcode')
+            self.emergency_gcode = CachedTemplate(
+                self.printer,
+                gcode_macro.load_template(config, 'emergency_gcode'),
+                config.get('emergency_gcode'))
         self.debounce_time = config.getfloat('debounce_time', 1.0, above=0.0)
         self.emergency_time = config.getfloat('emergency_time', 10, minval=1)
         self.enable_emergency = config.getboolean('enable_emergency', True)
-        self.rele_pin = config.get('rele_pin')
+        self.rele_pin = config.get('rele_pin', None)
+        self.feeder_relay = None
+        if self.rele_pin is not None:
+            self.feeder_relay = FeederRelay(config)
+        self.escalation = None
+        if config.getboolean('escalation', False):
+            self.escalation = RunoutEscalation(config, self.runout_pause)
+        self.predictor = None
+        if config.getboolean('predictive', False):
+            if self.feeder_relay is None:
+                raise config.error("predictive requires rele_pin in section"
+                                   " '%s'" % (config.get_name(),))
+            self.predictor = FeederPredictor(config)
+        self.pulser = None
+        feeder_mode = config.getchoice('feeder_mode',
+                                       {'continuous': 'continuous',
+                                        'pulsed': 'pulsed'}, 'continuous')
+        if feeder_mode == 'pulsed':
+            if self.feeder_relay is None:
+                raise config.error("feeder_mode pulsed requires rele_pin in"
+                                   " section '%s'" % (config.get_name(),))
+            if self.predictor is not None:
+                raise config.error("feeder_mode pulsed can not be used with"
+                                   " predictive in section '%s'"
+                                   % (config.get_name(),))
+            self.pulser = FeederPulser(config)
+        self.trace = PelletTrace(config)
+        self.history = PelletHistory(config)
+        self.rate_limiter = FeederRateLimiter(config)
+        self.majority_filter = None
+        filter_mode = config.getchoice('filter', {'debounce': 'debounce',
+                                                  'majority': 'majority'},
+                                       'debounce')
+        if filter_mode == 'majority':
+            self.majority_filter = MajorityFilter(config, self.debounce_time)
+        self.storm_filter = None
+        if config.getfloat('storm_rate', 0., minval=0.):
+            self.storm_filter = EdgeStormFilter(config)
+        self.tuner = None
+        if config.getboolean('autotune', False):
+            if self.majority_filter is not None:
+                raise config.error("autotune can not be used with filter"
+                                   " majority in section '%s'"
+                                   % (config.get_name(),))
+            self.tuner = DebounceTuner(config)
        
         # Internal state
         self.pellet_present = None
+        self.fill_level = None
         self.sensor_enabled = True
-        self.emergency_task = None
-        self.last_state_change_time = time.time()
+        self.last_state_change_time = self.reactor.monotonic()
+        self.stats = HopperStats(self.last_state_change_time)
+        self.status = None
+        self.status_time = 0.
+        self.status_version = 0
         self.last_action = None
-        self.last_emergency_time = None
+        self.is_printing = False
+        self.pause_resume = None
+        self.manager = lookup_pellet_sensor_manager(self.printer)
+        self.manager.register_sensor(self)
+        self.telemetry = None
+        telemetry_file = config.get('telemetry_file', None)
+        if telemetry_file is not None:
+            self.telemetry = self.manager.lookup_telemetry(telemetry_file)
+            self.history.telemetry = self.telemetry
+            self.history.sensor_id = self.telemetry.register_sensor(self.name)
+        self.recheck_timer = self.manager.register_deadline(
+            self._recheck_event)
+        self.emergency_task = self.manager.register_deadline(
+            self._emergency_watchdog)
+        self.switch_timer = self.manager.register_deadline(
+            self._switch_retry_event)
+        self.storm_timer = self.manager.register_deadline(self._storm_event)
+        self.predict_timer = self.manager.register_deadline(
+            self._predict_event)
+        self.escalation_timer = self.manager.register_deadline(
+            self._escalation_event)
+        self.pulse_timer = self.manager.register_deadline(self._pulse_event)
+        self.tune_timer = self.manager.register_deadline(self._autotune_event)
+        self.toolhead = None
 
         # Register commands and event handlers
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+        self.printer.register_event_handler("idle_timeout:printing",
+                                            self._handle_printing)
+        self.printer.register_event_handler("idle_timeout:ready",
+                                            self._handle_not_printing)
+        self.printer.register_event_handler("idle_timeout:idle",
+                                            self._handle_not_printing)
         self.gcode.register_mux_command(
             "QUERY_FILAMENT_SENSOR", "SENSOR", self.name,
             self.cmd_QUERY_FILAMENT_SENSOR,
@@ -56,19 +1021,134 @@ class RunoutHelper:
             "SET_FILAMENT_SENSOR", "SENSOR", self.name,
             self.cmd_SET_FILAMENT_SENSOR,
             desc=self.cmd_SET_FILAMENT_SENSOR_help)
+        self.gcode.register_mux_command(
+            "QUERY_PELLET_HISTORY", "SENSOR", self.name,
+            self.cmd_QUERY_PELLET_HISTORY,
+            desc=self.cmd_QUERY_PELLET_HISTORY_help)
+        self.gcode.register_mux_command(
+            "DUMP_PELLET_TRACE", "SENSOR", self.name,
+            self.cmd_DUMP_PELLET_TRACE,
+            desc=self.cmd_DUMP_PELLET_TRACE_help)
+        if self.tuner is not None:
+            self.gcode.register_mux_command(
+                "PELLET_SENSOR_AUTOTUNE", "SENSOR", self.name,
+                self.cmd_PELLET_SENSOR_AUTOTUNE,
+                desc=self.cmd_PELLET_SENSOR_AUTOTUNE_help)
         #logging.info("filament_switch_sensor initialized")
 
+    def _handle_connect(self):
+        if self.runout_pause:
+            self.pause_resume = self.printer.lookup_object('pause_resume')
+        if self.predictor is not None:
+            self.toolhead = self.printer.lookup_object('toolhead')
+        idle_timeout = self.printer.lookup_object("idle_timeout")
+        eventtime = self.reactor.monotonic()
+        state = idle_timeout.get_status(eventtime)["state"]
+        self.is_printing = state == "Printing"
+        if self.tuner is not None and self.tuner.interval:
+            self.manager.update_deadline(self.tune_timer,
+                                         eventtime + self.tuner.interval)
+
+    def _handle_printing(self, print_time):
+        self.is_printing = True
+        # Nessun fronte arriva all'inizio della stampa: valuta lo stato noto
+        if not self.sensor_enabled:
+            return
+        eventtime = self.reactor.monotonic()
+        if self.predictor is not None:
+            self.manager.update_deadline(self.predict_timer, eventtime)
+        if self.majority_filter is not None:
+            self.manager.update_deadline(self.recheck_timer,
+                                         eventtime + self.debounce_time)
+        elif self.pellet_present is not None:
+            waketime = max(eventtime,
+                           self.last_state_change_time + self.debounce_time)
+            self.manager.update_deadline(self.recheck_timer, waketime)
+
+    def _handle_not_printing(self, print_time):
+        self.is_printing = False
+        # Se non è in stampa ma il feeder potrebbe essere acceso spegne
+        self.cancel_recheck()
+        self.cancel_switch_retry()
+        self.cancel_predict()
+        if self.last_action != 'off' or self.rate_limiter.feeder_on:
+            self.filledup()
+
     def _runout_event_handler(self, eventtime):
         # Pausing from inside an event requires that the pause portion
         # of pause_resume execute immediately.
-        pause_prefix = ""
-        if self.runout_pause:
-            pause_resume = self.printer.lookup_object('pause_resume')
-            pause_resume.send_pause_command()
-            pause_prefix = "PAUSE\n"
-            self.printer.get_reactor().pause(eventtime + 0.5)
-        self._exec_gcode(pause_prefix, self.runout_gcode)
+        if self.runout_pause and self.escalation is None:
+            self.pause_resume.send_pause_command()
+            # Run runout_gcode once the pause has landed, without blocking
+            # the reactor in the meantime
+            self.reactor.register_callback(self._runout_pause_event,
+                                           eventtime + PAUSE_DELAY)
+            return
+        self._exec_gcode("", self.runout_gcode)
+
+    def _runout_pause_event(self, eventtime):
+        self._exec_gcode("PAUSE\n", self.runout_gcode)
         
+    def _escalation_event(self, eventtime):
+        escalation = self.escalation
+        if not escalation.warned and eventtime >= escalation.get_warn_time():
+            escalation.warned = True
+            elapsed = eventtime - escalation.start_time
+            self._respond_event("Pellet Sensor %s: hopper still empty after"
+                                " %.1fs" % (self.name, elapsed))
+        steps = escalation.get_throttle_steps(eventtime)
+        if steps > escalation.steps:
+            escalation.steps = steps
+            speed = escalation.get_speed()
+            logging.info("Pellet Sensor %s: speed factor lowered to %.0f%%",
+                         self.name, speed)
+            self._script_event("M220 S%.0f" % (speed,))
+        if (escalation.pause_time is not None and not escalation.paused
+            and eventtime >= escalation.get_pause_time()):
+            escalation.paused = True
+            self.pause_resume.send_pause_command()
+            self.reactor.register_callback(
+                (lambda e: self._run_script("PAUSE")),
+                eventtime + PAUSE_DELAY)
+        self.status = None
+        return escalation.get_next_time(self.reactor.NEVER)
+
+    def _start_escalation(self, eventtime):
+        if self.escalation.start_time is not None:
+            return
+        orig_speed = 100.
+        gcode_move = self.printer.lookup_object('gcode_move', None)
+        if gcode_move is not None:
+            orig_speed = gcode_move.get_status(eventtime)['speed_factor'] * 100.
+        self.escalation.start(eventtime, orig_speed)
+        self.manager.update_deadline(
+            self.escalation_timer,
+            self.escalation.get_next_time(self.reactor.NEVER))
+
+    def cancel_escalation(self):
+        escalation = self.escalation
+        if escalation is None or escalation.start_time is None:
+            return
+        self.manager.update_deadline(self.escalation_timer, self.reactor.NEVER)
+        if escalation.steps:
+            self._script_event("M220 S%.0f" % (escalation.orig_speed,))
+        escalation.stop()
+        self.status = None
+
+    def _script_event(self, script):
+        self.reactor.register_callback((lambda e: self._run_script(script)))
+
+    def _respond_event(self, msg):
+        logging.info(msg)
+        self.reactor.register_callback(
+            (lambda e: self.gcode.respond_info(msg)))
+
+    def _run_script(self, script):
+        try:
+            self.gcode.run_script(script)
+        except Exception:
+            logging.exception("Script running error")
+
     def _filledup_event_handler(self, eventtime):
         self._exec_gcode("", self.filledup_gcode)
 
@@ -77,94 +1157,358 @@ class RunoutHelper:
 
     def _exec_gcode(self, prefix, template):
         try:
-            self.gcode.run_script(prefix + template.render() + "\nM400")
+            eventtime = self.reactor.monotonic()
+            self.gcode.run_script(template.get_script(prefix, eventtime))
         except Exception:
             logging.exception("Script running error")
 
-    def note_filament_present(self, is_pellet_present):
+    def _check_switch_rate(self, eventtime, feeder_on):
+        waketime = self.rate_limiter.next_switch_time(eventtime, feeder_on)
+        if waketime <= eventtime:
+            return True
+        # Rimanda l'azione al primo istante consentito
+        if self.switch_timer.waketime == self.reactor.NEVER:
+            self.rate_limiter.suppressed_count += 1
+            self.history.record(eventtime, self.pellet_present,
+                                HIST_SUPPRESSED)
+            self.status = None
+        self.manager.update_deadline(self.switch_timer, waketime)
+        return False
+
+    def _switch_retry_event(self, eventtime):
+        if self.sensor_enabled and self.is_printing:
+            self._apply_debounced_state(eventtime)
+        return self.reactor.NEVER
+
+    def cancel_switch_retry(self):
+        self.manager.update_deadline(self.switch_timer, self.reactor.NEVER)
+
+    def _apply_debounced_state(self, eventtime):
+        # Applica la logica di debounce
+        if self.pellet_present and self.last_action != 'off':
+            if (self.predictor is not None
+                and self.predictor.prefeed_end is not None):
+                # A glitch while prefeeding: the prefeed runs to its end
+                self.last_action = 'off'
+                return
+            if not self._check_switch_rate(eventtime, False):
+                return
+            self.trace.record(TRACE_ACTIONS, eventtime, True, EV_FILLEDUP)
+            self.filledup(eventtime)
+        elif not self.pellet_present and self.last_action != 'on':
+            if not self._check_switch_rate(eventtime, True):
+                return
+            self.trace.record(TRACE_ACTIONS, eventtime, False, EV_RUNOUT)
+            self.runout(eventtime)
+
+    def _note_filtered_state(self, eventtime, state):
+        if state is None:
+            return
+        if state != self.pellet_present:
+            self._note_state_change(eventtime, state)
+            self.last_action = None
+        self._apply_debounced_state(eventtime)
+
+    def _recheck_event(self, eventtime):
+        # The timer is moved by every edge, so when it fires the state has
+        # been stable for debounce_time
+        self.trace.record(TRACE_EDGES, eventtime, self.pellet_present,
+                          EV_RECHECK)
+        if self.majority_filter is not None:
+            state = self.majority_filter.flush()
+            if self.sensor_enabled and self.is_printing:
+                self._note_filtered_state(eventtime, state)
+        elif self.sensor_enabled and self.is_printing:
+            self._apply_debounced_state(eventtime)
+        return self.reactor.NEVER
+
+    def cancel_recheck(self):
+        self.manager.update_deadline(self.recheck_timer, self.reactor.NEVER)
+
+    def _predict_event(self, eventtime):
+        if not (self.sensor_enabled and self.is_printing):
+            return self.reactor.NEVER
+        predictor = self.predictor
+        self._sample_extruder(eventtime)
+        if predictor.prefeed_end is not None:
+            if (eventtime >= predictor.prefeed_end and self.pellet_present
+                and self.rate_limiter.next_switch_time(
+                    eventtime, False) <= eventtime):
+                self.filledup(eventtime)
+        elif (self.pellet_present and not self.rate_limiter.feeder_on
+              and predictor.check_prefeed()
+              and self.rate_limiter.next_switch_time(
+                  eventtime, True) <= eventtime):
+            self._prefeed(eventtime)
+        return predictor.get_next_sample_time(eventtime)
+
+    def _prefeed(self, eventtime):
+        # Start the feeder ahead of the sensor, without a runout
+        self.trace.record(TRACE_ACTIONS, eventtime, True, EV_RUNOUT)
+        self.history.record(eventtime, self.pellet_present, HIST_RUNOUT)
+        self.predictor.start_prefeed(eventtime, self.reactor.NEVER)
+        if self.rate_limiter.note_switch(eventtime, True):
+            self.stats.note_feeder(eventtime, True)
+            self.status = None
+        self.feeder_relay.set_feeder(eventtime, True)
+
+    def _pulse_event(self, eventtime):
+        pulser = self.pulser
+        on_time = pulser.next_pulse(eventtime)
+        if on_time > pulser.period - 2. * PIN_MIN_TIME:
+            # No room left for the off edge before the next pulse (it would
+            # push every later pulse back): keep the feeder on instead
+            self.feeder_relay.set_feeder(eventtime, True)
+        else:
+            self.feeder_relay.pulse(eventtime, on_time)
+        self.status = None
+        return eventtime + pulser.period
+
+    def _start_pulses(self, eventtime):
+        if self.pulse_timer.waketime == self.reactor.NEVER:
+            self.pulser.start(eventtime)
+            self.manager.update_deadline(self.pulse_timer, eventtime)
+
+    def cancel_pulses(self, eventtime, filledup):
+        # The pulse already queued on the mcu is let run to its end
+        self.manager.update_deadline(self.pulse_timer, self.reactor.NEVER)
+        self.pulser.stop(eventtime, filledup)
+
+    def _autotune_event(self, eventtime):
+        result = self.tuner.tune(eventtime)
+        if result is not None:
+            self._set_debounce_time(eventtime, result[0])
+        return eventtime + self.tuner.interval
+
+    def _set_debounce_time(self, eventtime, debounce_time):
+        if debounce_time == self.debounce_time:
+            return
+        logging.info("Pellet Sensor %s: debounce_time set to %.3fs",
+                     self.name, debounce_time)
+        self.debounce_time = debounce_time
+        self.status = None
+        # A pending check follows the new window
+        if self.recheck_timer.waketime != self.reactor.NEVER:
+            waketime = max(eventtime,
+                           self.last_state_change_time + debounce_time)
+            self.manager.update_deadline(self.recheck_timer, waketime)
+
+    def _sample_extruder(self, eventtime):
+        if self.toolhead is not None:
+            self.predictor.sample(eventtime, self.toolhead.get_position()[3])
+
+    def cancel_predict(self):
+        self.manager.update_deadline(self.predict_timer, self.reactor.NEVER)
+
+    def _note_state_change(self, eventtime, is_pellet_present):
+        self.pellet_present = is_pellet_present
+        self.last_state_change_time = eventtime
+        self.history.record(eventtime, is_pellet_present, HIST_STATE)
+        self.status = None
+
+    def _storm_event(self, eventtime):
+        storm_filter = self.storm_filter
+        state, edge_time = storm_filter.flush(eventtime)
+        if state is not None:
+            self._handle_edge(state, edge_time)
+        if storm_filter.storming:
+            return storm_filter.get_window_end()
+        logging.info("Pellet Sensor %s: edge storm ended", self.name)
+        self.status = None
+        return self.reactor.NEVER
+
+    def _note_storm(self, eventtime):
+        if self.storm_timer.waketime != self.reactor.NEVER:
+            return
+        storm_filter = self.storm_filter
+        self.manager.update_deadline(self.storm_timer,
+                                     storm_filter.get_window_end())
+        self.status = None
+        msg = ("Pellet Sensor %s: more than %.0f edges per second, sensor"
+               " edges are coalesced" % (self.name, storm_filter.rate))
+        logging.warning(msg)
+        if storm_filter.warning and storm_filter.storm_count == 1:
+            self.gcode.respond_info(msg)
+
+    def note_filament_present(self, is_pellet_present, eventtime=None):
+        # Gli istanti sono quelli del fronte sul pin (eventtime dei buttons)
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        if (self.storm_filter is not None
+            and not self.storm_filter.note_edge(eventtime,
+                                                is_pellet_present)):
+            self._note_storm(eventtime)
+            return
+        self._handle_edge(is_pellet_present, eventtime)
 
-        current_time = time.time()
-        self.gcode.run_script("M118 triggered note_filament_present @ " + str(current_time) + " with status " + str(is_pellet_present))        
+    def _handle_edge(self, is_pellet_present, eventtime):
+        self.trace.record(TRACE_EDGES, eventtime, is_pellet_present,
+                          EV_EDGE)
+        self.stats.note_edge(eventtime)
+        if self.tuner is not None:
+            self.tuner.note_edge(eventtime)
+        self.status = None
+        if self.telemetry is not None:
+            self.telemetry.record(eventtime, self.history.sensor_id,
+                                  is_pellet_present, TELEMETRY_EDGE)
 
         # Verifica se il sensore è abilitato, se non lo è non fa nulla
         if not self.sensor_enabled:
             return
+
+        if self.majority_filter is not None:
+            # The filter follows the pin even when not printing
+            is_pellet_present = self.majority_filter.update(
+                eventtime, is_pellet_present)
         
-        # Verifica se la stampante è in stampa, nel caso non lo sia non fa nulla
-        eventtime = self.reactor.monotonic()
-        idle_timeout = self.printer.lookup_object("idle_timeout")
-        is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"
-        if not is_printing:
-            # Se non è in stampa ma il feeder potrebbe essere acceso spegne e ritorna 
-            if self.last_action != 'off':
-                self.filledup()
+        # Verifica se la stampante è in stampa, nel caso non lo sia tiene
+        # solo traccia dello stato del sensore
+        if not self.is_printing:
+            if (is_pellet_present is not None
+                and is_pellet_present != self.pellet_present):
+                self._note_state_change(eventtime, is_pellet_present)
             return
 
+        if self.majority_filter is not None:
+            # Flush the window once the pin has been quiet for a whole window
+            self.manager.update_deadline(
+                self.recheck_timer, eventtime + self.debounce_time)
+            self._note_filtered_state(eventtime, is_pellet_present)
+
         # Verifica se lo stato attuale è diverso dallo stato precedente
-        if is_pellet_present != self.pellet_present:
+        elif is_pellet_present != self.pellet_present:
             # Aggiorna lo stato corrente e il timestamp dell'ultima modifica
-            self.pellet_present = is_pellet_present
-            self.last_state_change_time = current_time
-
-            #logging.info("debounce started @ " + str(current_time) + " with status " + str(is_pellet_present))
-            self.gcode.run_script("M118 debounce started @ " + str(current_time) + " with status " + str(is_pellet_present))
+            self._note_state_change(eventtime, is_pellet_present)
+            self.trace.record(TRACE_EDGES, eventtime, is_pellet_present,
+                              EV_DEBOUNCE)
             # Resetta l'ultima azione
             self.last_action = None
 
-            # chiama la funzione dopo il tempo di debonce 
-            self.rerun_note_filament_present(is_pellet_present)
+            # Un solo controllo differito: ogni fronte sposta il timer
+            self.manager.update_deadline(
+                self.recheck_timer, eventtime + self.debounce_time)
 
         else:
             # Calcola la differenza di tempo dall'ultima modifica
-            time_diff = current_time - self.last_state_change_time
-
-            #logging.info("check after " + str(time_diff))
-            self.gcode.run_script("M118 check after " + str(time_diff))
+            time_diff = eventtime - self.last_state_change_time
+            self.trace.record(TRACE_EDGES, eventtime, is_pellet_present,
+                              EV_CHECK)
             # Verifica se è passato più di 1 secondo
             if time_diff >= self.debounce_time:
-                # Applica la logica di debounce
-                if is_pellet_present and self.last_action != 'off':
-                    #logging.info("execute filledup")
-                    self.gcode.run_script("M118 execute filledup")
-                    self.filledup()
-                elif not is_pellet_present and self.last_action != 'on':
-                    #logging.info("execute runout")
-                    self.gcode.run_script("M118 execute runout")
-                    self.runout()
-
-        # Verifica la logica di emergenza
-        if self.enable_emergency and self.last_emergency_time is not None:
-            emergency_time_diff = current_time - self.last_emergency_time
-            if emergency_time_diff >= 10.0:
-                if self.emergency_gcode is not None:
-                    self.emergency()
-
-    async def rerun_note_filament_present(self, is_pellet_present):
-        await asyncio.sleep(self.debounce_time + 0.1)
-        self.gcode.run_script("M118 rerun_note_filament_present after debounce time")
-        self.note_filament_present(is_pellet_present)
+                self.cancel_recheck()
+                self._apply_debounced_state(eventtime)
+
+    def _emergency_watchdog(self, eventtime):
+        # The feeder has been on for emergency_time without a filledup
+        self.trace.record(TRACE_ACTIONS, eventtime, self.pellet_present,
+                          EV_EMERGENCY)
+        self.history.record(eventtime, self.pellet_present, HIST_EMERGENCY)
+        self.emergency()
+        return self.reactor.NEVER
+
+    def cancel_emergency(self):
+        self.manager.update_deadline(self.emergency_task, self.reactor.NEVER)
 
     def emergency(self):
         self.reactor.register_callback(self._emergency_event_handler)
 
-    def runout(self):
-        #self.reactor.register_callback(self._runout_event_handler)
+    def runout(self, eventtime=None):
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        self.history.record(eventtime, self.pellet_present, HIST_RUNOUT)
+        self.stats.note_runout(self.last_state_change_time)
+        if self.predictor is not None:
+            # Only a debounced trip teaches the predictor, a glitch does not
+            self._sample_extruder(eventtime)
+            self.predictor.note_empty()
+        switched = self.rate_limiter.note_switch(eventtime, True)
+        if switched:
+            self.stats.note_feeder(eventtime, True)
+            self.status = None
+            if self.predictor is not None:
+                self._sample_extruder(eventtime)
+                self.predictor.note_feeder_on(eventtime)
+        elif self.predictor is not None:
+            # The sensor tripped while prefeeding: stop on the next filledup
+            self.predictor.prefeed_end = None
+        if self.pulser is not None:
+            self._start_pulses(eventtime)
+        elif self.feeder_relay is not None:
+            self.feeder_relay.set_feeder(eventtime, True)
+        # A runout while the feeder is already on (a bounce reset
+        # last_action, or a prefeed) does not queue runout_gcode again
+        if self.runout_gcode is not None and switched:
+            self.reactor.register_callback(self._runout_event_handler)
 
-        # Aggiorna il timestamp dell'ultima emergenza e l'ultima azione
-        self.last_emergency_time = time.time()
+        # Arma il watchdog di emergenza (se non già armato) e l'ultima azione
+        if (self.enable_emergency and self.emergency_gcode is not None
+            and self.emergency_task.waketime == self.reactor.NEVER):
+            self.manager.update_deadline(
+                self.emergency_task,
+                eventtime + self.emergency_time)
+        if self.escalation is not None:
+            self._start_escalation(eventtime)
         self.last_action = 'on'
 
-    def filledup(self):
-        #self.reactor.register_callback(self._filledup_event_handler)
+    def filledup(self, eventtime=None):
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        self.history.record(eventtime, self.pellet_present, HIST_FILLEDUP)
+        self.stats.note_filledup(self.last_state_change_time,
+                                 bool(self.pellet_present))
+        switched = self.rate_limiter.note_switch(eventtime, False)
+        if switched:
+            self.stats.note_feeder(eventtime, False)
+            self.status = None
+        if self.predictor is not None:
+            self._sample_extruder(eventtime)
+            self.predictor.note_feeder_off(
+                eventtime, bool(self.pellet_present
+                                and self.predictor.prefeed_end is None))
+        if self.pulser is not None:
+            self.cancel_pulses(eventtime, bool(self.pellet_present))
+        if self.feeder_relay is not None:
+            self.feeder_relay.set_feeder(eventtime, False)
+        # Like runout_gcode, filledup_gcode only follows an actual switch
+        # of the feeder (not a bounce, nor the end of a print)
+        if self.filledup_gcode is not None and switched:
+            self.reactor.register_callback(self._filledup_event_handler)
 
-        # Resettare il timestamp dell'emergenza quando il feeder viene spento e l'ultima azione
-        self.last_emergency_time = None
+        # Disarma il watchdog di emergenza quando il feeder viene spento
+        self.cancel_emergency()
+        self.cancel_escalation()
         self.last_action = 'off'
 
     def get_status(self, eventtime):
-        return {
+        # The dict is shared with the callers and never modified: a new one
+        # (with a new version) is built only after a change, or every
+        # STATUS_REFRESH_TIME for the time dependent statistics
+        if (self.status is not None
+            and eventtime < self.status_time + STATUS_REFRESH_TIME):
+            return self.status
+        self.status_version += 1
+        self.status_time = eventtime
+        self.status = {
             "filament_detected": bool(self.pellet_present),
-            "enabled": bool(self.sensor_enabled)}
+            "enabled": bool(self.sensor_enabled),
+            "feeder_on": self.rate_limiter.feeder_on,
+            "feeder_switches": self.rate_limiter.switch_count,
+            "suppressed_switches": self.rate_limiter.suppressed_count,
+            "stats": self.stats.get_status(eventtime),
+            "sensor_fault": (self.storm_filter is not None
+                             and self.storm_filter.storming),
+            "version": self.status_version}
+        if self.predictor is not None:
+            self.status["prediction"] = self.predictor.get_status(eventtime)
+        if self.pulser is not None:
+            self.status["pulse"] = self.pulser.get_status()
+        if self.fill_level is not None:
+            self.status["fill_level"] = round(self.fill_level, 1)
+        if self.tuner is not None:
+            self.status["debounce_time"] = self.debounce_time
+        if self.escalation is not None:
+            self.status["escalation"] = self.escalation.get_stage()
+        return self.status
     
     cmd_QUERY_FILAMENT_SENSOR_help = "Query the status of the pellet Sensor"
     def cmd_QUERY_FILAMENT_SENSOR(self, gcmd):
@@ -172,11 +1516,83 @@ class RunoutHelper:
             msg = "Pellet Sensor %s: pellet detected" % (self.name)
         else:
             msg = "Pellet Sensor %s: pellet not detected" % (self.name)
+        if self.fill_level is not None:
+            msg += " (level %.1f%%)" % (self.fill_level,)
         gcmd.respond_info(msg)
     
+    def note_level(self, level):
+        self.fill_level = level
+        self.status = None
+
     cmd_SET_FILAMENT_SENSOR_help = "Sets the pellet sensor on/off"
     def cmd_SET_FILAMENT_SENSOR(self, gcmd):
         self.sensor_enabled = gcmd.get_int("ENABLE", 1)
+        self.status = None
+        if not self.sensor_enabled:
+            self.cancel_recheck()
+            self.cancel_emergency()
+            self.cancel_escalation()
+            self.cancel_switch_retry()
+            self.cancel_predict()
+            if (self.predictor is not None
+                and self.predictor.prefeed_end is not None):
+                # Stop a prefeed, nothing would stop it otherwise
+                self.filledup()
+            if (self.pulser is not None
+                and self.pulse_timer.waketime != self.reactor.NEVER):
+                # Pulses are paused, without learning from the refill
+                eventtime = self.reactor.monotonic()
+                self.cancel_pulses(eventtime, False)
+                self.feeder_relay.set_feeder(eventtime, False)
+        elif self.is_printing:
+            eventtime = self.reactor.monotonic()
+            if self.predictor is not None:
+                self.manager.update_deadline(self.predict_timer, eventtime)
+            if self.pulser is not None and self.last_action == 'on':
+                self._start_pulses(eventtime)
+
+    cmd_QUERY_PELLET_HISTORY_help = "Query the pellet sensor history"
+    def cmd_QUERY_PELLET_HISTORY(self, gcmd):
+        count = gcmd.get_int("COUNT", 20, minval=1)
+        eventtime = self.reactor.monotonic()
+        lines = ["%.3f (%.1fs ago) %s state=%s" % (
+            t, eventtime - t, name, state)
+                 for t, name, state in self.history.get_records(count)]
+        gcmd.respond_info("Pellet Sensor %s history (%d of %d events):\n%s"
+                          % (self.name, len(lines), self.history.count,
+                             "\n".join(lines)))
+
+    cmd_PELLET_SENSOR_AUTOTUNE_help = "Tune debounce_time from the bounces"
+    def cmd_PELLET_SENSOR_AUTOTUNE(self, gcmd):
+        eventtime = self.reactor.monotonic()
+        tuner = self.tuner
+        result = tuner.tune(eventtime)
+        msg = "Pellet Sensor %s: %d bounces in %.1f minutes\n" % (
+            self.name, tuner.bounce_count,
+            tuner.get_observed_time(eventtime) / 60.)
+        if result is None:
+            msg += ("not enough data yet (needs %d bounces over %.1f"
+                    " minutes)\n" % (tuner.min_bounces,
+                                     tuner.min_time / 60.))
+        else:
+            msg += ("suggested debounce_time: %.3f (%.2f spurious"
+                    " switches/hour)\n" % result)
+        msg += "current debounce_time: %.3f" % (self.debounce_time,)
+        if result is not None and gcmd.get_int("APPLY", 0):
+            self._set_debounce_time(eventtime, result[0])
+            msg += "\ndebounce_time applied until the next restart"
+        gcmd.respond_info(msg)
+
+    cmd_DUMP_PELLET_TRACE_help = "Dump the debug trace of the pellet sensor"
+    def cmd_DUMP_PELLET_TRACE(self, gcmd):
+        count = gcmd.get_int("COUNT", None, minval=1)
+        lines = self.trace.format(count)
+        msg = "Pellet Sensor %s trace (%d events):\n%s" % (
+            self.name, len(lines), "\n".join(lines))
+        logging.info(msg)
+        gcmd.respond_info(msg)
+        if gcmd.get_int("CLEAR", 0):
+            self.trace.clear()
 
 class SwitchSensor:
     def __init__(self, config):
@@ -187,9 +1603,88 @@ class SwitchSensor:
         self.runout_helper = RunoutHelper(config)
         self.get_status = self.runout_helper.get_status
     def _button_handler(self, eventtime, state):
-        self.runout_helper.note_filament_present(state)
+        self.runout_helper.note_filament_present(state, eventtime)
+
+# Streaming median of the last level_median_samples readings, followed by
+# a first order low-pass filter with a level_smooth_time time constant
+class LevelFilter:
+    def __init__(self, config):
+        self.samples = collections.deque(
+            maxlen=config.getint('level_median_samples', 5, minval=1))
+        self.smooth_time = config.getfloat('level_smooth_time', 1., minval=0.)
+        self.value = None
+        self.last_time = 0.
+    def update(self, read_time, value):
+        self.samples.append(value)
+        median = sorted(self.samples)[len(self.samples) // 2]
+        if self.value is None or not self.smooth_time:
+            self.value = median
+        else:
+            dt = max(0., read_time - self.last_time)
+            self.value += dt / (self.smooth_time + dt) * (median - self.value)
+        self.last_time = read_time
+        return self.value
+
+ADC_SAMPLE_TIME = 0.001
+ADC_SAMPLE_COUNT = 8
+ADC_REPORT_TIME = 0.100
+LEVEL_REPORT_DELTA = 0.5
+
+# Analog hopper level probe: the fill percentage drives the same runout
+# logic, empty below low_level and full again above high_level
+class LevelSensor:
+    def __init__(self, config):
+        printer = config.get_printer()
+        self.reactor = printer.get_reactor()
+        self.empty_value = config.getfloat('level_empty_value', 0.)
+        self.full_value = config.getfloat('level_full_value', 1.)
+        if self.empty_value == self.full_value:
+            raise config.error("level_empty_value and level_full_value must"
+                               " differ in section '%s'"
+                               % (config.get_name(),))
+        self.low_level = config.getfloat('low_level', 20., minval=0.,
+                                         below=100.)
+        self.high_level = config.getfloat('high_level', 80.,
+                                          above=self.low_level, maxval=100.)
+        self.filter = LevelFilter(config)
+        ppins = printer.lookup_object('pins')
+        self.mcu_adc = ppins.setup_pin('adc', config.get('level_pin'))
+        self.mcu_adc.setup_minmax(ADC_SAMPLE_TIME, ADC_SAMPLE_COUNT)
+        self.mcu_adc.setup_adc_callback(ADC_REPORT_TIME, self._adc_callback)
+        query_adc = printer.load_object(config, 'query_adc')
+        query_adc.register_adc(config.get_name(), self.mcu_adc)
+        self.runout_helper = RunoutHelper(config)
+        self.get_status = self.runout_helper.get_status
+        # Only touched from the adc callback
+        self.state = None
+        self.reported_level = None
+    def _adc_callback(self, read_time, read_value):
+        value = self.filter.update(read_time, read_value)
+        level = (100. * (value - self.empty_value)
+                 / (self.full_value - self.empty_value))
+        level = min(100., max(0., level))
+        state = self.state
+        if state is None:
+            state = level > self.low_level
+        elif level < self.low_level:
+            state = False
+        elif level >= self.high_level:
+            state = True
+        if (state == self.state and self.reported_level is not None
+            and abs(level - self.reported_level) < LEVEL_REPORT_DELTA):
+            return
+        self.state = state
+        self.reported_level = level
+        self.reactor.register_async_callback(
+            (lambda e: self._level_event(e, state, level)))
+    def _level_event(self, eventtime, state, level):
+        self.runout_helper.note_level(level)
+        if state != self.runout_helper.pellet_present:
+            self.runout_helper.note_filament_present(state, eventtime)
 
 def load_config_prefix(config):
+    if config.get('level_pin', None) is not None:
+        return LevelSensor(config)
     return SwitchSensor(config)
 
 # [filament_switch_sensor my_sensor]
@@ -205,9 +1700,10 @@ def load_config_prefix(config):
 #     PAUSE is complete. The default is not to run any G-Code commands.
 #  filledup_gcode:
 #     A list of G-Code commands to execute after the pellet insert is
-#     detected. See docs/Command_Templates.md for G-Code format. The
-#     default is not to run any G-Code commands, which disables insert
-#     detection.
+#     detected and the feeder is switched off. It does not run when the
+#     feeder was already off. See docs/Command_Templates.md for G-Code
+#     format. The default is not to run any G-Code commands, which
+#     disables insert detection.
 #  emergency_gcode:
 #     A list of G-Code commands to execute after the emergency time is
 #     elapsed. See docs/Command_Templates.md for G-Code format. The
@@ -215,7 +1711,29 @@ def load_config_prefix(config):
 #     detection.
 #  sensor_pin:
 #     The pin on which the sensor is connected. This parameter must be
-#     provided.
+#     provided, unless level_pin is set.
+#  level_pin:
+#     The analog pin of a hopper level probe (for example an ultrasonic
+#     or capacitive probe). When set, the sensor reads a fill level
+#     instead of sensor_pin: the hopper is empty once the level drops
+#     below low_level and filled up once it reaches high_level again,
+#     and the level is reported in the fill_level status field. The
+#     default is to use sensor_pin.
+#  level_empty_value: 0.0
+#  level_full_value: 1.0
+#     The adc readings (between 0.0 and 1.0) of an empty and of a full
+#     hopper. The full value may be below the empty one for probes
+#     measuring a distance. Defaults are 0.0 and 1.0.
+#  low_level: 20
+#  high_level: 80
+#     Fill levels, in percent, at which the hopper is considered empty
+#     and full again. Defaults are 20 and 80.
+#  level_median_samples: 5
+#     Number of adc reports (one every 100ms) the level is the median
+#     of, which drops isolated spikes. Default is 5.
+#  level_smooth_time: 1.0
+#     Time constant in seconds of the low-pass filter applied after the
+#     median, 0 disables it. Default is 1.0 seconds.
 #  debounce_time: 1.0
 #     The time in seconds between each sample of the sensor. Default is
 #     1.0 seconds.
@@ -225,6 +1743,147 @@ def load_config_prefix(config):
 #  enable_emergency: True
 #     When set to True, the emergency event is triggered after the
 #     emergency_time is elapsed. Default is True.
-#  rele_pin (NOT IMPLEMENTED YET):
-#     The pin on which the feeder is connected. This parameter must be
-#     provided.
\ No newline at end of file
+#  min_on_time: 0
+#     Minimum time in seconds the feeder is kept on before it may be
+#     switched off. Default is 0.
+#  min_off_time: 0
+#     Minimum time in seconds the feeder is kept off before it may be
+#     switched on again. Default is 0.
+#  max_switches_per_minute: 0
+#     Maximum number of feeder switches in any 60 second window, 0
+#     disables the limit. A runout or filledup that would exceed one of
+#     these limits is delayed until it is allowed and counted in the
+#     suppressed_switches status field. Default is 0.
+#  filter: debounce
+#     How the sensor edges are filtered. With 'debounce' a state is acted
+#     on once it has been stable for debounce_time. With 'majority' the
+#     pin is sampled window_samples times per debounce_time and the
+#     pellet is considered present when at least high_threshold of the
+#     samples are high and missing when at most low_threshold are high,
+#     so a chattering sensor still settles. Default is 'debounce'.
+#  window_samples: 16
+#     Number of samples in the majority window. Default is 16.
+#  high_threshold:
+#     Number of high samples needed to report the pellet present. Default
+#     is 3/4 of window_samples.
+#  low_threshold:
+#     Number of high samples at or below which the pellet is reported
+#     missing. Default is 1/4 of window_samples.
+#  trace_level: 1
+#     Amount of events recorded in the in-memory debug trace: 0 disables
+#     the trace, 1 records runout/filledup/emergency decisions and 2 also
+#     records every sensor edge and debounce check. The trace is only
+#     printed by the DUMP_PELLET_TRACE command. Default is 1.
+#  trace_size: 256
+#     Number of events kept in the debug trace. Default is 256.
+#  history_size: 1024
+#     Number of sensor state changes and feeder actions kept in the
+#     history reported by the QUERY_PELLET_HISTORY command. Each event
+#     takes 9 bytes of memory. Default is 1024.
+#  telemetry_file:
+#     Path of an append-only binary log of the sensor edges, state
+#     changes and feeder actions, written in the background once per
+#     second. Sensors may share the same file. The sensor names of each
+#     session are appended to a .sensors file next to the log. The log
+#     can be read with scripts/pellet_telemetry.py. If the file can not
+#     be opened or written, the error is logged and telemetry stops for
+#     the rest of the session. The default is not to write a log.
+#  storm_rate: 0
+#     Maximum rate of sensor edges, in edges per second. When more edges
+#     arrive in a storm_window, as with a failing sensor or a loose wire,
+#     the sensor is reported as faulty (sensor_fault status field) and
+#     the edges are coalesced into a single sample handled at the end of
+#     each window, until a whole window stays below the rate. 0 disables
+#     the storm detection. Default is 0.
+#  storm_window: 1.0
+#     Length in seconds of the window used to measure the edge rate.
+#     Default is 1.0 seconds.
+#  storm_warning: True
+#     When set to True, a warning is reported on the console the first
+#     time an edge storm is detected. Default is True.
+#  autotune: False
+#     When set to True, the time between the sensor edges is measured and
+#     the PELLET_SENSOR_AUTOTUNE command reports the shortest
+#     debounce_time that keeps the spurious switches (bounces lasting at
+#     least debounce_time) below autotune_target_rate per hour, applying
+#     it with APPLY=1. Edges closer than autotune_max_debounce are taken
+#     as bounces, so it should be below the shortest genuine refill
+#     cycle. Can not be used with filter majority. Default is False.
+#  autotune_min_debounce: 0.05
+#  autotune_max_debounce: 2.0
+#     Range in seconds of the tuned debounce_time. Defaults are 0.05 and
+#     2.0 seconds.
+#  autotune_target_rate: 1.0
+#     Accepted spurious switches per hour. Default is 1.0.
+#  autotune_interval: 0
+#     When set, the tuned debounce_time is applied every
+#     autotune_interval seconds. The default is to only apply it through
+#     PELLET_SENSOR_AUTOTUNE APPLY=1.
+#  autotune_min_time: 600
+#  autotune_min_bounces: 20
+#     No debounce_time is suggested or applied before the edges have
+#     been observed for autotune_min_time seconds and at least
+#     autotune_min_bounces bounces have been seen. Defaults are 600
+#     seconds and 20 bounces.
+#  escalation: False
+#     When set to True, a runout that lasts is escalated in stages
+#     instead of pausing the print at once: a console warning after
+#     escalation_warn_time, then the speed factor (M220) is lowered by
+#     escalation_throttle_step percent every escalation_throttle_interval
+#     seconds starting at escalation_throttle_time, down to
+#     escalation_min_speed percent of the original speed. With
+#     pause_on_runout the print is only paused after
+#     escalation_pause_time. The speed factor is restored at filledup.
+#     All times are in seconds from the runout. Default is False.
+#  escalation_warn_time: 5
+#  escalation_throttle_time: 10
+#  escalation_throttle_interval: 5
+#  escalation_throttle_step: 10
+#  escalation_min_speed: 50
+#  escalation_pause_time: 60
+#     See the escalation option. The defaults are shown above.
+#  predictive: False
+#     When set to True, the feeder is started before the sensor reports
+#     the hopper empty. The pellet consumption is estimated from the
+#     commanded extruder position, and each refill teaches how much
+#     extrusion a full hopper lasts and how fast the feeder refills it.
+#     The feeder is then started predict_lead_time before the hopper is
+#     predicted to run out and kept on for as long as it needs to refill
+#     what was used. Requires rele_pin. Default is False.
+#  predict_lead_time: 2.0
+#     How many seconds before the predicted runout the feeder is
+#     started. Default is 2.0 seconds.
+#  predict_interval: 0.5
+#     Interval in seconds between two samples of the extruder position.
+#     Default is 0.5 seconds.
+#  predict_smooth_time: 5.0
+#     Time constant in seconds of the consumption rate average. Default
+#     is 5.0 seconds.
+#  rele_pin:
+#     The pin on which the feeder relay is connected. The relay is
+#     switched on at runout and off at filledup directly through the
+#     micro-controller, without going through G-Code. The default is not
+#     to drive a relay, in which case the feeder must be controlled from
+#     runout_gcode and filledup_gcode.
+#  feeder_mode: continuous
+#     How the relay on rele_pin feeds an empty hopper. With continuous
+#     the relay is on from runout to filledup. With pulsed the relay is
+#     switched on for pulse_duty of every pulse_period until filledup,
+#     each pulse being queued on the micro-controller as a whole, and
+#     the duty is adapted after every refill so that a refill takes
+#     about pulse_refill_time. This keeps the level near the sensor
+#     instead of overfilling the hopper, at the cost of one relay
+#     switch per pulse. A duty leaving less than 0.2 seconds off per
+#     period drives the relay continuously. Pulses are paused while the
+#     sensor is disabled. Requires rele_pin and can not be used with
+#     predictive. The default is continuous.
+#  pulse_period: 2.0
+#     Period in seconds of the feeder pulses. Default is 2.0 seconds.
+#  pulse_duty: 0.5
+#     Initial fraction of pulse_period during which the feeder is on.
+#     Default is 0.5.
+#  pulse_min_duty: 0.2
+#     Lowest duty the adaptation may reach. Default is 0.2.
+#  pulse_refill_time: 10.0
+#     Desired duration in seconds of a refill in pulsed mode. Default is
+#     10.0 seconds.
\ No newline at end of file
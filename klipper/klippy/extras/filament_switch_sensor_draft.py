@@ -12,7 +12,7 @@ import logging
 from datetime import datetime
 
 class RunoutHelper:
-    def __init__(self):
+    def __init__(self, config=None, use_thread=False):
         self.sensor_state = False  # Stato iniziale del sensore
         self.last_sensor_state = None  # Stato precedente del sensore
         self.debounce_interval = 1.0  # Intervallo di debounce in secondi
@@ -23,7 +23,19 @@ class RunoutHelper:
         #impostazioni della classe
         self.sensor_enabled = True
 
-        # Creazione del thread per il debounce
+        self.reactor = None
+        if not use_thread:
+            # Event driven debounce: a single reactor timer that only wakes
+            # up at last_state_change_time + debounce_interval
+            self.printer = config.get_printer()
+            self.reactor = reactor = self.printer.get_reactor()
+            self.last_state_change_time = reactor.monotonic()
+            self.debounce_timer = reactor.register_timer(
+                self._debounce_event,
+                self.last_state_change_time + self.debounce_interval)
+            return
+
+        # Creazione del thread per il debounce (solo per i test offline)
         self.debounce_thread = threading.Thread(target=self._debounce_thread)
         self.debounce_thread.daemon = True  # Il thread si fermerà quando il programma principale termina
         self.debounce_thread.start()
@@ -88,6 +100,18 @@ class RunoutHelper:
 
             time.sleep(0.1)  # Sleep per evitare utilizzo eccessivo della CPU
 
+    def _debounce_event(self, eventtime):
+        if not self.sensor_action_taken:
+            elapsed_time = eventtime - self.last_state_change_time
+            self.debugPrintOnMonitor(
+                "Debounce interval elapsed %.3fs" % (elapsed_time,))
+            if self.sensor_state:
+                self.on_sensor_true()
+            else:
+                self.on_sensor_false()
+            self.sensor_action_taken = True
+        return self.reactor.NEVER
+
     def note_filament_present(self, is_pellet_present):
         self.debugPrintOnMonitor("Filament Detected" if is_pellet_present else "Filament Not Detected")
         # Verifica se il sensore è abilitato, se non lo è non fa nulla
@@ -104,6 +128,18 @@ class RunoutHelper:
         #         self.on_sensor_true()
         #     return
         
+        if self.reactor is not None:
+            if is_pellet_present == self.sensor_state:
+                return
+            # Ogni cambio di stato sposta l'unico risveglio del timer
+            self.sensor_state = is_pellet_present
+            self.last_state_change_time = self.reactor.monotonic()
+            self.sensor_action_taken = False
+            self.reactor.update_timer(
+                self.debounce_timer,
+                self.last_state_change_time + self.debounce_interval)
+            return
+
         # Aggiorniamo lo stato del sensore
         self.sensor_state = is_pellet_present
 
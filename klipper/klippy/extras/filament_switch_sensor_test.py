@@ -1,22 +1,36 @@
 import unittest
+import os
+import sys
 import time
 from unittest.mock import MagicMock
-from filament_switch_sensor_draft import RunoutHelper  
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', '..', 'scripts'))
+from pellet_sim import SimConfig, SimPrinter
+import filament_switch_sensor_draft
+from filament_switch_sensor_draft import RunoutHelper
 
 class TestRunoutHelper(unittest.TestCase):
     def setUp(self):
-        self.runout_helper = RunoutHelper()
+        # Il tempo e' virtuale: il reactor simulato sostituisce time.sleep
+        self.printer = SimPrinter()
+        self.reactor = self.printer.get_reactor()
+        self.config = SimConfig(self.printer, "filament_switch_sensor hopper",
+                                {"sensor_pin": "PA0"})
+        self.runout_helper = RunoutHelper(self.config)
+
+    def sleep(self, delay):
+        self.reactor.advance(delay)
         
     # def test_single_true_call(self):
     #     print("--- Test single true call ---")
     #     self.runout_helper.note_filament_present(True)
-    #     time.sleep(1.5)
+    #     self.sleep(1.5)
     #     self.assertFalse(self.runout_helper.rele_result)
 
     # def test_single_false_call(self):
     #     print("--- Test single false call ---")
     #     self.runout_helper.note_filament_present(False)
-    #     time.sleep(1.5)
+    #     self.sleep(1.5)
     #     self.assertTrue(self.runout_helper.rele_result)
 
     def test_multiple_calls(self):
@@ -24,30 +38,68 @@ class TestRunoutHelper(unittest.TestCase):
         # Setup iniziale del sensore
         print("Initial Setup")
         self.runout_helper.note_filament_present(True)
-        time.sleep(1.5)
+        self.sleep(1.5)
         
         # Chiamate in rapida successione
         print("Bouncing")
         self.runout_helper.note_filament_present(False)
-        time.sleep(0.11)
+        self.sleep(0.11)
         self.runout_helper.note_filament_present(True)
-        time.sleep(0.11)
+        self.sleep(0.11)
         self.runout_helper.note_filament_present(False)
-        time.sleep(0.11)
+        self.sleep(0.11)
         self.runout_helper.note_filament_present(True)
-        time.sleep(0.11)
+        self.sleep(0.11)
         self.runout_helper.note_filament_present(False)
 
         # Attesa per 0.5 secondi dall'ultima chiamata
         print("Check too soon")
-        time.sleep(0.5)
+        self.sleep(0.5)
         self.assertFalse(self.runout_helper.rele_result)
 
         # Attesa per 1 ulteriore secondo
         print("Corret check after 1 second")
-        time.sleep(1)
+        self.sleep(1)
+        self.assertTrue(self.runout_helper.rele_result)
+
+        self.sleep(5)
+
+    def test_single_wakeup(self):
+        self.runout_helper.note_filament_present(True)
+        self.sleep(0.25)
+        self.runout_helper.note_filament_present(True)
+        self.sleep(60.)
+        self.assertEqual(self.reactor.wakeups, 1)
+        self.assertFalse(self.runout_helper.rele_result)
+        timer = self.runout_helper.debounce_timer
+        self.assertEqual(timer.waketime, self.reactor.NEVER)
+
+    def test_switch_sensor(self):
+        sensor = filament_switch_sensor_draft.load_config_prefix(self.config)
+        self.assertIs(sensor.runout_helper.reactor, self.reactor)
+        sensor._button_handler(self.reactor.monotonic(), True)
+        self.sleep(1.5)
+        self.assertFalse(sensor.runout_helper.rele_result)
+
+class TestRunoutHelperThread(unittest.TestCase):
+    # Il debounce originale basato sul thread, senza reactor
+    def setUp(self):
+        self.runout_helper = RunoutHelper(use_thread=True)
+        self.runout_helper.debounce_interval = 0.3
+
+    def test_thread_debounce(self):
+        self.assertTrue(self.runout_helper.debounce_thread.is_alive())
+        self.runout_helper.note_filament_present(True)
+        time.sleep(0.1)
+        self.assertTrue(self.runout_helper.rele_result)
+        time.sleep(0.6)
+        self.assertFalse(self.runout_helper.rele_result)
+
+        self.runout_helper.note_filament_present(False)
+        time.sleep(0.1)
+        self.assertFalse(self.runout_helper.rele_result)
+        time.sleep(0.6)
         self.assertTrue(self.runout_helper.rele_result)
 
-        time.sleep(5)
 if __name__ == '__main__':
     unittest.main()
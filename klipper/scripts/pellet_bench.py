@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Benchmark the pellet sensor edge handling on a simulated printer
+#
+# Copyright (C) 2024 Giacomo Guaresi <giacomo.guaresi@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, time, gc, sys, tracemalloc
+import pellet_sim
+
+# Seconds between two edges of the same sensor
+SCENARIOS = {
+    'clean': 3.,       # every edge ends in a runout or filledup
+    'chatter': 0.005,  # 200Hz bouncing that never settles
+}
+
+def build_edges(count, num_sensors, interval):
+    # Round robin over the sensors, each one toggling its pin
+    edges = []
+    step = interval / num_sensors
+    for i in range(count):
+        edges.append((1. + i * step, i % num_sensors, (i // num_sensors) % 2))
+    return edges
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.
+    pos = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.))
+    return sorted_values[pos]
+
+def make_simulation(num_sensors, options):
+    sim = pellet_sim.PelletSimulation()
+    names = ["hopper%d" % (i,) for i in range(num_sensors)]
+    for name in names:
+        sim.add_sensor(name, **options)
+    sim.start()
+    return sim, names
+
+def measure_latency(num_sensors, edges, options):
+    sim, names = make_simulation(num_sensors, options)
+    set_sensor = sim.set_sensor
+    run_until = sim.reactor.run_until
+    clock = time.perf_counter
+    latencies = [None] * len(edges)
+    gc.disable()
+    try:
+        blocks = sys.getallocatedblocks()
+        start = clock()
+        for i, (eventtime, index, state) in enumerate(edges):
+            run_until(eventtime)
+            edge_start = clock()
+            set_sensor(names[index], state)
+            latencies[i] = clock() - edge_start
+        run_until(edges[-1][0] + 60.)
+        elapsed = clock() - start
+        # Each stored latency is one float block
+        blocks = sys.getallocatedblocks() - blocks - len(edges)
+    finally:
+        gc.enable()
+    latencies.sort()
+    return {
+        'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99), 'max': latencies[-1],
+        'edges_per_sec': len(edges) / elapsed,
+        'blocks_per_edge': float(blocks) / len(edges),
+        'timers': len(sim.reactor.timers),
+        'wakeups_per_edge': float(sim.reactor.wakeups) / len(edges)}
+
+def measure_allocations(num_sensors, edges, options):
+    # Peak of the memory allocated while handling a single edge
+    sim, names = make_simulation(num_sensors, options)
+    total = 0
+    tracemalloc.start()
+    try:
+        for eventtime, index, state in edges:
+            sim.reactor.run_until(eventtime)
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            sim.set_sensor(names[index], state)
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return float(total) / len(edges)
+
+def run_benchmark(sensor_counts=(1, 8, 64), edge_count=20000,
+                  scenarios=('clean', 'chatter'), options={}):
+    results = []
+    for scenario in scenarios:
+        for num_sensors in sensor_counts:
+            edges = build_edges(edge_count, num_sensors, SCENARIOS[scenario])
+            res = measure_latency(num_sensors, edges, options)
+            res['alloc_bytes_per_edge'] = measure_allocations(
+                num_sensors, edges[:min(len(edges), 2000)], options)
+            res['scenario'] = scenario
+            res['sensors'] = num_sensors
+            res['edges'] = len(edges)
+            results.append(res)
+    return results
+
+def format_results(results):
+    lines = ["%-8s %7s %8s %8s %8s %8s %10s %8s %8s %6s %7s" % (
+        "scenario", "sensors", "p50(us)", "p90(us)", "p99(us)", "max(us)",
+        "edges/s", "bytes/e", "blocks/e", "timers", "wake/e")]
+    for res in results:
+        lines.append(
+            "%-8s %7d %8.1f %8.1f %8.1f %8.1f %10.0f %8.1f %8.2f %6d %7.2f" % (
+                res['scenario'], res['sensors'], res['p50'] * 1000000.,
+                res['p90'] * 1000000., res['p99'] * 1000000.,
+                res['max'] * 1000000., res['edges_per_sec'],
+                res['alloc_bytes_per_edge'], res['blocks_per_edge'],
+                res['timers'], res['wakeups_per_edge']))
+    return "\n".join(lines)
+
+def parse_options(value):
+    options = {}
+    for opt in value.split(','):
+        if opt.strip():
+            name, val = opt.split('=', 1)
+            options[name.strip()] = val.strip()
+    return options
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--sensors", type="string", dest="sensors",
+                    default="1,8,64", help="comma separated sensor counts")
+    opts.add_option("-e", "--edges", type="int", dest="edges",
+                    default=20000, help="number of edges per run")
+    opts.add_option("--scenario", type="choice", dest="scenario",
+                    choices=list(SCENARIOS) + ['all'], default='all',
+                    help="edge pattern to replay")
+    opts.add_option("-o", "--options", type="string", dest="options",
+                    default="", help="sensor config, e.g. filter=majority")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    sensor_counts = [int(v) for v in options.sensors.split(',')]
+    scenarios = list(SCENARIOS)
+    if options.scenario != 'all':
+        scenarios = [options.scenario]
+    results = run_benchmark(sensor_counts, options.edges, scenarios,
+                            parse_options(options.options))
+    print(format_results(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# Replay recorded pellet sensor edges and sweep the debounce parameters
+#
+# Copyright (C) 2024 Giacomo Guaresi <giacomo.guaresi@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, bisect, itertools, multiprocessing
+import pellet_sim, pellet_telemetry, pellet_bench
+import filament_switch_sensor
+
+# Seconds of simulated time before the first edge and after the last one
+REPLAY_START = 1.
+REPLAY_END_TIME = 60.
+
+def load_sessions(filename, sensor=None):
+    # A list of the edges of each klippy session, from a telemetry log
+    # (with its .sensors file) or from a text file with one
+    # "eventtime state" pair per line and a "session" line before each
+    # new session. Each session is sorted, as edges may be recorded late.
+    # A telemetry log shared by several sensors needs the sensor to replay.
+    sessions = []
+    if os.path.exists(filename + ".sensors"):
+        with pellet_telemetry.TelemetryLog(filename) as log:
+            names = sorted(set(name for first, session_names in log.sessions
+                               for name in session_names))
+            if sensor is None and len(names) > 1:
+                raise ValueError("%s holds the sensors %s, select one"
+                                 % (filename, ", ".join(names)))
+            for session, t, name, state, decision in log.iter_named_records():
+                if decision != filament_switch_sensor.TELEMETRY_EDGE:
+                    continue
+                if sensor is not None and name != sensor:
+                    continue
+                while len(sessions) <= session:
+                    sessions.append([])
+                sessions[session].append((t, state == 1))
+    else:
+        sessions.append([])
+        with open(filename, "r") as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                if line == "session":
+                    sessions.append([])
+                    continue
+                t, state = line.replace(',', ' ').split()[:2]
+                sessions[-1].append((float(t), int(state) != 0))
+    sessions = [edges for edges in sessions if edges]
+    for edges in sessions:
+        edges.sort(key=lambda e: e[0])
+    return sessions
+
+def join_sessions(sessions):
+    # The host clock restarts with each session: the sessions are laid
+    # one after the other, REPLAY_END_TIME apart
+    edges = []
+    for session in sessions:
+        offset = 0.
+        if edges:
+            offset = edges[-1][0] + REPLAY_END_TIME - session[0][0]
+        edges.extend((t + offset, state) for t, state in session)
+    return edges
+
+def load_edges(filename, sensor=None):
+    return join_sessions(load_sessions(filename, sensor))
+
+def find_missed_runouts(edges, feeder_commands, min_empty):
+    # Empty periods of the raw pin, long enough to need the feeder, during
+    # which the feeder was never on
+    switch_times = [t for t, v in feeder_commands]
+    missed = 0
+    for i, (t, state) in enumerate(edges):
+        if state or (i and not edges[i - 1][1]):
+            continue
+        end = edges[-1][0] + REPLAY_END_TIME
+        for next_t, next_state in edges[i + 1:]:
+            if next_state:
+                end = next_t
+                break
+        if end - t < min_empty:
+            continue
+        pos = bisect.bisect_right(switch_times, t)
+        feeder_on = pos > 0 and feeder_commands[pos - 1][1]
+        while not feeder_on and pos < len(switch_times):
+            if switch_times[pos] > end:
+                break
+            feeder_on = feeder_commands[pos][1]
+            pos += 1
+        if not feeder_on:
+            missed += 1
+    return missed
+
+def replay(edges, debounce_time, emergency_time, options={}, min_empty=5.):
+    options = dict(options)
+    options['debounce_time'] = debounce_time
+    options['emergency_time'] = emergency_time
+    options.setdefault('emergency_gcode', 'M118 pellet emergency')
+    options.setdefault('history_size', 2 * len(edges) + 64)
+    sim = pellet_sim.PelletSimulation()
+    sensor = sim.add_sensor("replay", **options)
+    sim.start()
+    offset = REPLAY_START - edges[0][0] if edges else 0.
+    sim.replay("replay", [(t + offset, state) for t, state in edges])
+    end_time = REPLAY_START + REPLAY_END_TIME
+    if edges:
+        end_time += edges[-1][0] + offset
+    sim.run_until(end_time)
+    helper = sensor.runout_helper
+    status = helper.get_status(sim.reactor.monotonic())
+    counts = {}
+    for t, name, state in helper.history.get_records():
+        counts[name] = counts.get(name, 0) + 1
+    refill = status["stats"]["refill_time"]
+    shifted = [(t + offset, state) for t, state in edges]
+    return {
+        'debounce_time': debounce_time, 'emergency_time': emergency_time,
+        'switches': status["feeder_switches"],
+        'suppressed': status["suppressed_switches"],
+        'runouts': counts.get("runout", 0),
+        'emergencies': counts.get("emergency", 0),
+        'missed_runouts': find_missed_runouts(
+            shifted, sim.get_feeder_pin("replay").commands, min_empty),
+        'refill_mean': refill["mean"], 'refill_max': refill["max"] or 0.}
+
+# Each worker process receives the edges once
+worker_edges = None
+
+def init_worker(edges):
+    global worker_edges
+    worker_edges = edges
+
+def run_worker(args):
+    debounce_time, emergency_time, options, min_empty = args
+    return replay(worker_edges, debounce_time, emergency_time, options,
+                  min_empty)
+
+def sweep(edges, debounce_times, emergency_times, options={}, min_empty=5.,
+          processes=None):
+    tasks = [(d, e, options, min_empty)
+             for d, e in itertools.product(debounce_times, emergency_times)]
+    if processes == 1:
+        init_worker(edges)
+        return [run_worker(task) for task in tasks]
+    pool = multiprocessing.Pool(processes, init_worker, (edges,))
+    try:
+        return pool.map(run_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def format_results(results):
+    lines = ["%8s %9s %8s %10s %7s %11s %6s %9s %9s" % (
+        "debounce", "emergency", "switches", "suppressed", "runouts",
+        "emergencies", "missed", "refill(s)", "max(s)")]
+    for res in results:
+        lines.append("%8.3f %9.1f %8d %10d %7d %11d %6d %9.2f %9.2f" % (
+            res['debounce_time'], res['emergency_time'], res['switches'],
+            res['suppressed'], res['runouts'], res['emergencies'],
+            res['missed_runouts'], res['refill_mean'], res['refill_max']))
+    return "\n".join(lines)
+
+def parse_floats(value):
+    return [float(v) for v in value.split(',') if v.strip()]
+
+def main():
+    usage = "%prog [options] <trace file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--debounce", type="string", dest="debounce",
+                    default="0.05,0.1,0.25,0.5,1.0",
+                    help="comma separated debounce_time values")
+    opts.add_option("-e", "--emergency", type="string", dest="emergency",
+                    default="10", help="comma separated emergency_time values")
+    opts.add_option("-s", "--sensor", type="string", dest="sensor",
+                    default=None, help="sensor to replay from a telemetry log")
+    opts.add_option("-m", "--min-empty", type="float", dest="min_empty",
+                    default=5., help="shortest empty period needing a refill")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+                    help="number of worker processes")
+    opts.add_option("-o", "--options", type="string", dest="options",
+                    default="", help="sensor config, e.g. filter=majority")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    try:
+        edges = load_edges(args[0], options.sensor)
+    except ValueError as e:
+        opts.error("%s with --sensor" % (e,))
+    if not edges:
+        opts.error("No edges found in %s" % (args[0],))
+    results = sweep(edges, parse_floats(options.debounce),
+                    parse_floats(options.emergency),
+                    pellet_bench.parse_options(options.options),
+                    options.min_empty, options.jobs)
+    print("%d edges over %.1fs" % (len(edges), edges[-1][0] - edges[0][0]))
+    print(format_results(results))
+
+if __name__ == '__main__':
+    main()
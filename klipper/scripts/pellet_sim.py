@@ -0,0 +1,519 @@
+# Simulated printer for offline runs of the pellet sensor module
+#
+# Copyright (C) 2024 Giacomo Guaresi <giacomo.guaresi@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, sys, heapq, configparser
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy', 'extras'))
+import filament_switch_sensor
+
+class sentinel:
+    pass
+
+
+######################################################################
+# Reactor with a virtual clock
+######################################################################
+
+class SimTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+        self.seq = 0
+
+class SimReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self, start_time=0.):
+        self.now = start_time
+        self.timers = []
+        self.heap = []
+        self.seq = 0
+        self.wakeups = 0
+    def monotonic(self):
+        return self.now
+    def register_timer(self, callback, waketime=NEVER):
+        timer = SimTimer(callback, self.NEVER)
+        self.timers.append(timer)
+        self.update_timer(timer, waketime)
+        return timer
+    def unregister_timer(self, timer):
+        timer.waketime = self.NEVER
+        self.timers.remove(timer)
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+        if waketime == self.NEVER:
+            return
+        self.seq += 1
+        timer.seq = self.seq
+        heapq.heappush(self.heap, (waketime, self.seq, timer))
+    def register_callback(self, callback, waketime=NOW):
+        def run_once(eventtime):
+            self.unregister_timer(timer)
+            callback(eventtime)
+            return self.NEVER
+        timer = self.register_timer(run_once, waketime)
+    def register_async_callback(self, callback, waketime=NOW):
+        # There are no other threads in the simulation
+        self.register_callback(callback, waketime)
+    def pause(self, waketime):
+        self.run_until(waketime)
+        return self.now
+    def run_until(self, endtime):
+        heap = self.heap
+        while heap and heap[0][0] <= endtime:
+            waketime, seq, timer = heapq.heappop(heap)
+            if seq != timer.seq or waketime != timer.waketime:
+                continue
+            self.now = max(self.now, waketime)
+            self.wakeups += 1
+            timer.waketime = self.NEVER
+            self.update_timer(timer, timer.callback(self.now))
+        self.now = max(self.now, endtime)
+    def advance(self, delay):
+        self.run_until(self.now + delay)
+
+
+######################################################################
+# Config
+######################################################################
+
+class SimConfig:
+    error = configparser.Error
+    def __init__(self, printer, section, options):
+        self.printer = printer
+        self.section = section
+        self.options = {k: str(v) for k, v in options.items()}
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.section
+    def _get_wrapper(self, parser, option, default, minval=None, maxval=None,
+                     above=None, below=None):
+        if option not in self.options:
+            if default is not sentinel:
+                return default
+            raise self.error("Option '%s' in section '%s' must be specified"
+                             % (option, self.section))
+        try:
+            v = parser(self.options[option])
+        except ValueError:
+            raise self.error("Unable to parse option '%s' in section '%s'"
+                             % (option, self.section))
+        if minval is not None and v < minval:
+            raise self.error("Option '%s' in section '%s' must have minimum"
+                             " of %s" % (option, self.section, minval))
+        if maxval is not None and v > maxval:
+            raise self.error("Option '%s' in section '%s' must have maximum"
+                             " of %s" % (option, self.section, maxval))
+        if above is not None and v <= above:
+            raise self.error("Option '%s' in section '%s' must be above %s"
+                             % (option, self.section, above))
+        if below is not None and v >= below:
+            raise self.error("Option '%s' in section '%s' must be below %s"
+                             % (option, self.section, below))
+        return v
+    def get(self, option, default=sentinel, note_valid=True):
+        return self._get_wrapper(str, option, default)
+    def getint(self, option, default=sentinel, minval=None, maxval=None,
+               note_valid=True):
+        return self._get_wrapper(int, option, default, minval, maxval)
+    def getfloat(self, option, default=sentinel, minval=None, maxval=None,
+                 above=None, below=None, note_valid=True):
+        return self._get_wrapper(float, option, default, minval, maxval,
+                                 above, below)
+    def getboolean(self, option, default=sentinel, note_valid=True):
+        def parse_bool(value):
+            states = configparser.RawConfigParser.BOOLEAN_STATES
+            if value.lower() not in states:
+                raise ValueError(value)
+            return states[value.lower()]
+        return self._get_wrapper(parse_bool, option, default)
+    def getchoice(self, option, choices, default=sentinel, note_valid=True):
+        if choices and type(list(choices.keys())[0]) == int:
+            c = self.getint(option, default)
+        else:
+            c = self.get(option, default)
+        if c not in choices:
+            raise self.error("Choice '%s' for option '%s' in section '%s'"
+                             " is not a valid choice" % (c, option,
+                                                         self.section))
+        return choices[c]
+
+
+######################################################################
+# G-Code
+######################################################################
+
+class SimCommandError(Exception):
+    pass
+
+class SimGCodeCommand:
+    error = SimCommandError
+    def __init__(self, gcode, command, params):
+        self.gcode = gcode
+        self.command = command
+        self.params = params
+    def get_command(self):
+        return self.command
+    def get_command_parameters(self):
+        return self.params
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg)
+    def get(self, name, default=sentinel, parser=str, minval=None,
+            maxval=None, above=None, below=None):
+        value = self.params.get(name)
+        if value is None:
+            if default is sentinel:
+                raise self.error("Error on '%s': missing %s"
+                                 % (self.command, name))
+            return default
+        try:
+            value = parser(value)
+        except ValueError:
+            raise self.error("Unable to parse '%s' as a %s" % (value, name))
+        if ((minval is not None and value < minval)
+            or (maxval is not None and value > maxval)
+            or (above is not None and value <= above)
+            or (below is not None and value >= below)):
+            raise self.error("Error on '%s': %s out of range"
+                             % (self.command, name))
+        return value
+    def get_int(self, name, default=sentinel, minval=None, maxval=None):
+        return self.get(name, default, parser=int, minval=minval,
+                        maxval=maxval)
+    def get_float(self, name, default=sentinel, minval=None, maxval=None,
+                  above=None, below=None):
+        return self.get(name, default, parser=float, minval=minval,
+                        maxval=maxval, above=above, below=below)
+
+class SimGCode:
+    error = SimCommandError
+    def __init__(self):
+        self.commands = {}
+        self.mux_commands = {}
+        self.scripts = []
+        self.responses = []
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        prev_key, values = self.mux_commands.setdefault(cmd, (key, {}))
+        values[value] = func
+    def run_script(self, script):
+        self.scripts.append(script)
+    run_script_from_command = run_script
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+    def run_command(self, line):
+        parts = line.split()
+        cmd = parts[0].upper()
+        params = dict(p.split('=', 1) for p in parts[1:])
+        params = {k.upper(): v for k, v in params.items()}
+        gcmd = SimGCodeCommand(self, cmd, params)
+        if cmd in self.mux_commands:
+            key, values = self.mux_commands[cmd]
+            func = values.get(params.get(key))
+            if func is None:
+                raise self.error("The value '%s' is not valid for %s"
+                                 % (params.get(key), key))
+            return func(gcmd)
+        return self.commands[cmd](gcmd)
+
+class SimTemplate:
+    def __init__(self, script):
+        self.script = script
+    def render(self, context=None):
+        return self.script
+
+class SimGCodeMacro:
+    def load_template(self, config, option, default=sentinel):
+        if default is sentinel:
+            return SimTemplate(config.get(option))
+        return SimTemplate(config.get(option, default))
+
+
+######################################################################
+# Printer objects
+######################################################################
+
+class SimButtons:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.callbacks = {}
+        self.states = {}
+    def register_buttons(self, pins, callback):
+        for pin in pins:
+            self.callbacks[pin] = callback
+    def set_pin(self, pin, state, eventtime=None):
+        # Like the mcu buttons code, only changes are reported. The
+        # eventtime may be in the past to model a late host callback.
+        state = bool(state)
+        if self.states.get(pin) == state:
+            return
+        self.states[pin] = state
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        self.callbacks[pin](eventtime, state)
+
+class SimMCU:
+    def estimated_print_time(self, eventtime):
+        # The simulated mcu clock runs on the host clock
+        return eventtime
+    def print_time_to_clock(self, print_time):
+        return int(print_time * 1000000.)
+
+class SimDigitalOut:
+    def __init__(self, mcu, pin):
+        self.mcu = mcu
+        self.pin = pin
+        self.start_value = self.shutdown_value = 0.
+        self.max_duration = 2.
+        self.commands = []
+    def get_mcu(self):
+        return self.mcu
+    def setup_max_duration(self, max_duration):
+        self.max_duration = max_duration
+    def setup_start_value(self, start_value, shutdown_value):
+        self.start_value = start_value
+        self.shutdown_value = shutdown_value
+    def set_digital(self, print_time, value):
+        if self.commands and print_time < self.commands[-1][0]:
+            raise Exception("Pin %s scheduled in the past" % (self.pin,))
+        self.commands.append((print_time, value))
+    def get_value(self, print_time):
+        value = self.start_value
+        for cmd_time, cmd_value in reversed(self.commands):
+            if cmd_time <= print_time:
+                return cmd_value
+        return value
+
+class SimADC:
+    # Reports value every report_time, like the mcu analog_in reports
+    def __init__(self, reactor, pin):
+        self.reactor = reactor
+        self.pin = pin
+        self.value = 0.
+        self.report_time = None
+        self.callback = None
+    def setup_minmax(self, sample_time, sample_count, minval=0., maxval=1.,
+                     range_check_count=0):
+        pass
+    def setup_adc_callback(self, report_time, callback):
+        self.report_time = report_time
+        self.callback = callback
+        self.reactor.register_timer(self._report, self.reactor.NOW)
+    def _report(self, eventtime):
+        self.callback(eventtime, self.value)
+        return eventtime + self.report_time
+
+class SimQueryADC:
+    def __init__(self):
+        self.adc = {}
+    def register_adc(self, name, mcu_adc):
+        self.adc[name] = mcu_adc
+
+class SimPins:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.mcu = SimMCU()
+        self.pins = {}
+    def setup_pin(self, pin_type, pin_desc):
+        if pin_desc in self.pins:
+            raise Exception("pin %s used multiple times in config"
+                            % (pin_desc,))
+        if pin_type == 'adc':
+            pin = SimADC(self.reactor, pin_desc)
+        elif pin_type == 'digital_out':
+            pin = SimDigitalOut(self.mcu, pin_desc)
+        else:
+            raise Exception("Simulated pin type %s not supported"
+                            % (pin_type,))
+        self.pins[pin_desc] = pin
+        return pin
+
+class SimIdleTimeout:
+    def __init__(self, printer):
+        self.printer = printer
+        self.state = "Idle"
+    def get_status(self, eventtime):
+        return {"state": self.state, "printing_time": 0.}
+    def set_printing(self, printing):
+        eventtime = self.printer.get_reactor().monotonic()
+        if printing:
+            self.state = "Printing"
+            self.printer.send_event("idle_timeout:printing", eventtime)
+        else:
+            self.state = "Ready"
+            self.printer.send_event("idle_timeout:ready", eventtime)
+
+class SimToolhead:
+    # Extrudes at a constant rate, set with set_extrude_rate()
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.e_pos = 0.
+        self.e_time = reactor.monotonic()
+        self.e_rate = 0.
+    def _update(self):
+        now = self.reactor.monotonic()
+        self.e_pos += self.e_rate * (now - self.e_time)
+        self.e_time = now
+    def set_extrude_rate(self, rate):
+        self._update()
+        self.e_rate = rate
+    def get_position(self):
+        self._update()
+        return [0., 0., 0., self.e_pos]
+    def get_status(self, eventtime):
+        return {'position': self.get_position()}
+
+class SimGCodeMove:
+    def __init__(self):
+        self.speed_factor = 1.
+    def get_status(self, eventtime):
+        return {'speed_factor': self.speed_factor}
+
+class SimPauseResume:
+    def __init__(self):
+        self.pause_count = 0
+    def send_pause_command(self):
+        self.pause_count += 1
+
+class SimPrinter:
+    config_error = configparser.Error
+    def __init__(self, start_time=0.):
+        self.reactor = SimReactor(start_time)
+        self.event_handlers = {}
+        self.objects = {
+            'gcode': SimGCode(), 'gcode_macro': SimGCodeMacro(),
+            'buttons': SimButtons(self.reactor),
+            'idle_timeout': SimIdleTimeout(self),
+            'pins': SimPins(self.reactor), 'query_adc': SimQueryADC(),
+            'pause_resume': SimPauseResume(), 'gcode_move': SimGCodeMove(),
+            'toolhead': SimToolhead(self.reactor)}
+    def get_reactor(self):
+        return self.reactor
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=sentinel):
+        if name in self.objects:
+            return self.objects[name]
+        if default is sentinel:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        prefix = module + ' '
+        return [(n, o) for n, o in self.objects.items()
+                if n == module or n.startswith(prefix)]
+    def load_object(self, config, section, default=sentinel):
+        return self.lookup_object(section, default)
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+
+
+######################################################################
+# Simulation driver
+######################################################################
+
+class SimHopper:
+    # Pellet level fed by the feeder relay and drained by the extruder,
+    # with the sensor tripping below threshold (a level sensor reads the
+    # level itself)
+    def __init__(self, sim, name, level, threshold, fill_rate, feed_delay,
+                 step):
+        self.sim = sim
+        self.name = name
+        self.level = self.min_level = self.max_level = level
+        self.threshold = threshold
+        self.fill_rate = fill_rate
+        self.feed_delay = feed_delay
+        self.step = step
+        self.pin = sim.get_feeder_pin(name)
+        self.toolhead = sim.printer.lookup_object('toolhead')
+        self.last_e = self.toolhead.get_position()[3]
+        self.starved_time = 0.
+        self.timer = sim.reactor.register_timer(self._update,
+                                                sim.reactor.NOW)
+    def _update(self, eventtime):
+        e_pos = self.toolhead.get_position()[3]
+        level = self.level - (e_pos - self.last_e)
+        self.last_e = e_pos
+        if self.pin.get_value(eventtime - self.feed_delay):
+            level += self.fill_rate * self.step
+        if level <= 0.:
+            level = 0.
+            self.starved_time += self.step
+        self.level = level
+        self.min_level = min(self.min_level, level)
+        self.max_level = max(self.max_level, level)
+        if self.sim.sensor_pins[self.name] is None:
+            # A level sensor reads 0.0 to 1.0 for a level of 0 to 100
+            self.sim.set_level(self.name, level / 100.)
+        else:
+            self.sim.set_sensor(self.name, level >= self.threshold)
+        return eventtime + self.step
+
+class PelletSimulation:
+    def __init__(self, start_time=0.):
+        self.printer = SimPrinter(start_time)
+        self.reactor = self.printer.get_reactor()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.buttons = self.printer.lookup_object('buttons')
+        self.idle_timeout = self.printer.lookup_object('idle_timeout')
+        self.sensors = {}
+        self.sensor_pins = {}
+        self.sensor_options = {}
+    def add_sensor(self, name, **options):
+        if 'level_pin' not in options:
+            options.setdefault('sensor_pin', 'sim_%s' % (name,))
+        options.setdefault('rele_pin', 'sim_%s_feeder' % (name,))
+        # An option set to None is left out of the config
+        options = {k: v for k, v in options.items() if v is not None}
+        section = "filament_switch_sensor %s" % (name,)
+        config = SimConfig(self.printer, section, options)
+        sensor = filament_switch_sensor.load_config_prefix(config)
+        self.printer.add_object(section, sensor)
+        self.sensors[name] = sensor
+        self.sensor_pins[name] = options.get('sensor_pin')
+        self.sensor_options[name] = options
+        return sensor
+    def add_level_sensor(self, name, **options):
+        options.setdefault('level_pin', 'sim_%s_level' % (name,))
+        return self.add_sensor(name, **options)
+    def start(self, printing=True):
+        self.printer.send_event("klippy:connect")
+        self.printer.send_event("klippy:ready")
+        if printing:
+            self.set_printing(True)
+    def set_printing(self, printing):
+        self.idle_timeout.set_printing(printing)
+    def get_feeder_pin(self, name):
+        pins = self.printer.lookup_object('pins').pins
+        return pins.get(self.sensor_options[name].get('rele_pin'))
+    def add_hopper(self, name, level=100., threshold=50., fill_rate=10.,
+                   feed_delay=0., step=0.05):
+        return SimHopper(self, name, level, threshold, fill_rate, feed_delay,
+                         step)
+    def set_extrude_rate(self, rate):
+        self.printer.lookup_object('toolhead').set_extrude_rate(rate)
+    def set_sensor(self, name, state, eventtime=None):
+        self.buttons.set_pin(self.sensor_pins[name], state, eventtime)
+    def set_level(self, name, value):
+        # Raw adc value of a level sensor, reported at the next adc report
+        pins = self.printer.lookup_object('pins').pins
+        pins[self.sensor_options[name]['level_pin']].value = value
+    def advance(self, delay):
+        self.reactor.advance(delay)
+    def run_until(self, eventtime):
+        self.reactor.run_until(eventtime)
+    def replay(self, name, edges):
+        # edges is an iterable of (eventtime, state) sorted by time
+        for eventtime, state in edges:
+            self.reactor.run_until(eventtime)
+            self.set_sensor(name, state)
+    def run_command(self, line):
+        return self.gcode.run_command(line)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Read the binary telemetry log written by the pellet sensors
+#
+# Copyright (C) 2024 Giacomo Guaresi <giacomo.guaresi@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, mmap, array, bisect, collections
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy', 'extras'))
+import filament_switch_sensor
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RECORD = filament_switch_sensor.TELEMETRY_RECORD
+DECISION_NAMES = filament_switch_sensor.TELEMETRY_NAMES
+STATE_NAMES = filament_switch_sensor.HISTORY_STATE_NAMES
+NUMPY_DTYPE = [('time', '<f8'), ('sensor', '<u2'), ('state', 'u1'),
+               ('decision', 'u1')]
+
+def read_sessions(filename):
+    # List of (first record, sensor names) of each klippy session. A file
+    # without session markers holds the names of a single session.
+    sessions = []
+    try:
+        with open(filename + ".sensors", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[0] == "session":
+                    sessions.append((int(parts[1]), []))
+                elif parts:
+                    if not sessions:
+                        sessions.append((0, []))
+                    sessions[-1][1].append(parts[0])
+    except IOError:
+        pass
+    if not sessions or sessions[0][0]:
+        sessions.insert(0, (0, []))
+    return sessions
+
+class TelemetryLog:
+    def __init__(self, filename):
+        self.filename = filename
+        self.sessions = read_sessions(filename)
+        self.session_starts = [start for start, names in self.sessions]
+        self.sensor_names = self.sessions[-1][1]
+        self.file = open(filename, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        # A partial record at the end (still being written) is ignored
+        self.count = size // RECORD.size
+        self.data = None
+        if self.count:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def get_session(self, index):
+        # Session of the record at index
+        return bisect.bisect_right(self.session_starts, index) - 1
+    def sensor_name(self, sensor_id, session=-1):
+        names = self.sessions[session][1]
+        if sensor_id < len(names):
+            return names[sensor_id]
+        return "sensor%d" % (sensor_id,)
+    def _iter_range(self, start, end):
+        view = memoryview(self.data)[start * RECORD.size:end * RECORD.size]
+        return RECORD.iter_unpack(view)
+    def iter_records(self):
+        if not self.count:
+            return iter(())
+        return self._iter_range(0, self.count)
+    def iter_sessions(self):
+        # (session, records) for each session holding records. Times
+        # restart with each session, as the host clock does.
+        bounds = self.session_starts[1:] + [self.count]
+        for session, start in enumerate(self.session_starts):
+            end = min(bounds[session], self.count)
+            if end > start:
+                yield session, self._iter_range(start, end)
+    def iter_named_records(self):
+        for session, records in self.iter_sessions():
+            names = self.sessions[session][1]
+            for t, sensor, state, decision in records:
+                name = names[sensor] if sensor < len(names) else (
+                    "sensor%d" % (sensor,))
+                yield session, t, name, state, decision
+    def get_columns(self):
+        # Copies of the records as columns, with the session of each
+        # record, still valid after close()
+        if numpy is not None:
+            records = self.get_numpy()
+            columns = {name: records[name] for name, dtype in NUMPY_DTYPE}
+            columns['session'] = numpy.searchsorted(
+                self.session_starts, numpy.arange(self.count),
+                side='right') - 1
+            return columns
+        times = array.array('d', [0.]) * self.count
+        sensors = array.array('H', [0]) * self.count
+        states = array.array('B', [0]) * self.count
+        decisions = array.array('B', [0]) * self.count
+        sessions = array.array('H', [0]) * self.count
+        for i, (t, sensor, state, decision) in enumerate(self.iter_records()):
+            times[i] = t
+            sensors[i] = sensor
+            states[i] = state
+            decisions[i] = decision
+            sessions[i] = self.get_session(i)
+        return {'time': times, 'sensor': sensors, 'state': states,
+                'decision': decisions, 'session': sessions}
+    def get_numpy(self):
+        # A copy, the mmap can not be closed while a view of it is alive
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        if not self.count:
+            return numpy.zeros(0, dtype=NUMPY_DTYPE)
+        return numpy.frombuffer(self.data, dtype=NUMPY_DTYPE,
+                                count=self.count).copy()
+
+def summarize(log):
+    counts = collections.defaultdict(collections.Counter)
+    sessions = {}
+    for session, t, name, state, decision in log.iter_named_records():
+        counts[name][decision] += 1
+        first, last = sessions.get(session, (t, t))
+        sessions[session] = (first, t)
+    lines = ["%d records in %d sessions" % (log.count, len(sessions))]
+    for session in sorted(sessions):
+        first, last = sessions[session]
+        lines.append("session %d: time %.3f - %.3f (%.1fs)" % (
+            session, first, last, last - first))
+    for name in sorted(counts):
+        lines.append("%s: %s" % (name, " ".join(
+            "%s=%d" % (DECISION_NAMES[decision], count)
+            for decision, count in sorted(counts[name].items()))))
+    return lines
+
+def dump(log, count):
+    lines = []
+    start = max(0, log.count - count)
+    for i, (session, t, name, state, decision) in enumerate(
+            log.iter_named_records()):
+        if i >= start:
+            lines.append("%d %.3f %s %s state=%s" % (
+                session, t, name, DECISION_NAMES[decision],
+                STATE_NAMES[state]))
+    return lines
+
+def main():
+    usage = "%prog [options] <telemetry file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dump", type="int", dest="dump", default=0,
+                    help="print the last DUMP records")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    with TelemetryLog(args[0]) as log:
+        if options.dump:
+            lines = dump(log, options.dump)
+        else:
+            lines = summarize(log)
+    print("\n".join(lines))
+
+if __name__ == '__main__':
+    main()
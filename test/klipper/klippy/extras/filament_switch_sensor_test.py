@@ -1,65 +1,1245 @@
 import unittest
-from unittest.mock import MagicMock, patch
 import os
+import math
 import sys
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
 
-# Aggiungi il percorso del progetto alla sys.path
-project_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../../"))
-sys.path.insert(0, project_path)
+# Aggiungi la cartella degli script alla sys.path
+scripts_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../../klipper/scripts"))
+sys.path.insert(0, scripts_path)
 
-# Ora puoi importare il modulo
-from klipper.klippy.extras.filament_switch_sensor import RunoutHelper
+# Il modulo viene importato una sola volta, dallo stesso percorso del
+# simulatore (klippy/extras)
+import pellet_sim
+import filament_switch_sensor
+from filament_switch_sensor import RunoutHelper
+
+class TestSingleModule(unittest.TestCase):
+
+    def test_same_module(self):
+        self.assertIs(pellet_sim.filament_switch_sensor, filament_switch_sensor)
+        self.assertNotIn('klipper.klippy.extras.filament_switch_sensor',
+                         sys.modules)
 
 class TestRunoutHelper(unittest.TestCase):
 
     def setUp(self):
-        # Create a mock config for testing
-        self.mock_config = MagicMock()
+        self.sim = pellet_sim.PelletSimulation()
+        self.sim.add_sensor("hopper", pause_on_runout=True,
+                            runout_gcode='M118 runout',
+                            filledup_gcode='M118 filledup')
+        self.pause_resume = self.sim.printer.lookup_object('pause_resume')
 
     def test_init(self):
-        # Test the initialization of RunoutHelper
-        with patch('klipper.klippy.extras.filament_switch_sensor.RunoutHelper._exec_gcode') as mock_exec_gcode:
-            runout_helper = RunoutHelper(self.mock_config)
+        self.sim.start()
+        runout_helper = self.sim.sensors["hopper"].runout_helper
+        self.assertIsNone(runout_helper.pellet_present)
+        self.assertEqual(runout_helper.sensor_enabled, True)
+        self.assertEqual(runout_helper.rate_limiter.feeder_on, False)
+        # No script runs before the first sensor edge
+        self.sim.advance(5.)
+        self.assertEqual(self.sim.gcode.scripts, [])
 
-            # Assert that the initialization sets up the necessary attributes
-            self.assertEqual(runout_helper.pellet_present, False)
-            self.assertEqual(runout_helper.sensor_enabled, True)
-            self.assertEqual(runout_helper.feeder_status, False)
+    def test_note_filament_present(self):
+        self.sim.start()
+        # Pellet missing while printing: pause and runout_gcode
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts,
+                         ["PAUSE\nM118 runout\nM400"])
+        self.assertEqual(self.pause_resume.pause_count, 1)
+        # Pellet back: filledup_gcode
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts[1:], ["M118 filledup\nM400"])
+        # Pellet missing while not printing: nothing runs
+        self.sim.set_printing(False)
+        del self.sim.gcode.scripts[:]
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts, [])
+        self.assertEqual(self.pause_resume.pause_count, 1)
 
-            # Assert that the _exec_gcode method is called with the correct arguments
-            mock_exec_gcode.assert_called_once_with("", runout_helper.runout_gcode)
+class TestRunoutHelperDeferredCheck(unittest.TestCase):
 
-    def test_note_filament_present(self):
-        # Test the note_filament_present method
-        runout_helper = RunoutHelper(self.mock_config)
-
-        # Mock the reactor and idle_timeout for testing
-        mock_reactor = MagicMock()
-        mock_idle_timeout = MagicMock()
-        runout_helper.reactor = mock_reactor
-        runout_helper.printer.lookup_object.return_value = mock_idle_timeout
-
-        # Mock the _exec_gcode method
-        with patch('klipper.klippy.extras.filament_switch_sensor.RunoutHelper._exec_gcode') as mock_exec_gcode:
-            # Test when pellet is present and sensor is enabled
-            runout_helper.note_filament_present(True)
-            mock_exec_gcode.assert_called_once_with("", runout_helper.filledup_gcode)
-            mock_reactor.pause.assert_not_called()
-
-            # Test when pellet is not present and printer is printing
-            mock_exec_gcode.reset_mock()
-            runout_helper.note_filament_present(False)
-            mock_exec_gcode.assert_called_once_with("", runout_helper.runout_gcode)
-            mock_reactor.pause.assert_called_once()
-
-            # Test when pellet is not present and printer is not printing
-            mock_exec_gcode.reset_mock()
-            mock_idle_timeout.get_status.return_value = {"state": "Idle"}
-            runout_helper.note_filament_present(False)
-            mock_exec_gcode.assert_not_called()
-            mock_reactor.pause.assert_not_called()
-
-    # Add more test cases as needed
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.sensor = self.sim.add_sensor("hopper")
+        self.sim.start()
+        self.runout_helper = self.sensor.runout_helper
+        self.manager = self.sim.printer.lookup_object('pellet_sensors')
+
+    def test_runout_after_debounce(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(0.9)
+        self.assertIsNone(self.runout_helper.last_action)
+        self.sim.advance(0.2)
+        self.assertEqual(self.runout_helper.last_action, 'on')
+
+    def test_edges_coalesce(self):
+        for i in range(50):
+            self.sim.set_sensor("hopper", i % 2)
+            self.sim.advance(0.05)
+        self.assertEqual(self.manager.pending, 1)
+        self.sim.advance(1.0)
+        self.assertEqual(self.runout_helper.last_action, 'off')
+
+    def test_disable_cancels_check(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.run_command("SET_FILAMENT_SENSOR SENSOR=hopper ENABLE=0")
+        self.sim.advance(5.)
+        self.assertIsNone(self.runout_helper.last_action)
+
+    def test_repeated_filledup(self):
+        sim = pellet_sim.PelletSimulation()
+        sim.add_sensor("hopper", filledup_gcode='M118 filledup')
+        sim.start()
+        runout_helper = sim.sensors["hopper"].runout_helper
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        # A bounce shorter than debounce_time, with the feeder never on
+        sim.set_sensor("hopper", False)
+        sim.advance(0.1)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        # Print end with the feeder off
+        sim.set_printing(False)
+        sim.advance(1.)
+        self.assertEqual(runout_helper.rate_limiter.switch_count, 0)
+        self.assertEqual(sim.gcode.scripts, [])
+        # A real refill runs it once
+        sim.set_printing(True)
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        self.assertEqual(sim.gcode.scripts, ["M118 filledup\nM400"])
+
+    def test_not_printing(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.set_printing(False)
+        self.sim.advance(5.)
+        self.assertEqual(self.runout_helper.last_action, 'off')
+
+    def test_print_start(self):
+        self.sim.set_printing(False)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(5.)
+        self.assertEqual(self.runout_helper.last_action, 'off')
+        self.assertFalse(self.runout_helper.get_status(0.)["filament_detected"])
+        self.sim.set_printing(True)
+        self.sim.advance(0.)
+        self.assertEqual(self.runout_helper.last_action, 'on')
+
+    def test_no_lookups_on_edge(self):
+        self.sim.printer.objects.clear()
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.runout_helper.last_action, 'on')
+
+class TestPelletTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", trace_level=2, trace_size=4)
+        self.sim.start()
+        self.runout_helper = sensor.runout_helper
+
+    def test_ring_buffer(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts, [])
+        lines = self.runout_helper.trace.format()
+        self.assertEqual(lines, ["0.000 edge state=False",
+                                 "0.000 debounce state=False",
+                                 "1.000 recheck state=False",
+                                 "1.000 runout state=False"])
+        self.sim.set_sensor("hopper", True)
+        lines = self.runout_helper.trace.format(2)
+        self.assertEqual(lines, ["2.000 edge state=True",
+                                 "2.000 debounce state=True"])
+
+    def test_dump_command(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.run_command("DUMP_PELLET_TRACE SENSOR=hopper CLEAR=1")
+        self.assertIn("hopper trace (2 events)", self.sim.gcode.responses[0])
+        self.assertEqual(self.runout_helper.trace.format(), [])
+
+class TestPelletSensorManager(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.names = ["hopper%d" % (i,) for i in range(8)]
+        for i, name in enumerate(self.names):
+            self.sim.add_sensor(name, debounce_time=1. + i)
+        self.sim.start()
+        self.manager = self.sim.printer.lookup_object('pellet_sensors')
+
+    def test_single_timer(self):
+        self.assertIsInstance(self.manager,
+                              filament_switch_sensor
+                              .PelletSensorManager)
+        self.assertEqual(len(self.sim.reactor.timers), 1)
+        self.assertEqual(sorted(self.manager.sensors), self.names)
+
+    def test_deadlines(self):
+        for name in self.names:
+            self.sim.set_sensor(name, False)
+        self.sim.advance(1.)
+        self.assertEqual(self.manager.next_waketime, 2.)
+        self.sim.advance(3.)
+        status = self.manager.get_status(self.sim.reactor.now)
+        self.assertEqual(status["feeding"], self.names[:4])
+        self.assertEqual(status["empty"], self.names)
+        self.assertEqual(status["sensors"]["hopper0"]["filament_detected"],
+                         False)
+
+    def test_stale_entries(self):
+        for i in range(1000):
+            self.sim.set_sensor("hopper0", i % 2)
+            self.sim.advance(0.01)
+        self.assertLess(len(self.manager.heap), 200)
+        self.sim.advance(1.)
+        helper = self.manager.sensors["hopper0"]
+        self.assertEqual(helper.last_action, 'off')
+        self.assertEqual(self.manager.pending, 0)
+        self.assertEqual(self.manager.next_waketime, self.sim.reactor.NEVER)
+
+    def test_deadline_runs_once_per_pass(self):
+        calls = []
+        def callback(eventtime):
+            calls.append(eventtime)
+            if len(calls) < 3:
+                return eventtime
+            return self.sim.reactor.NEVER
+        deadline = self.manager.register_deadline(callback, 5.)
+        self.manager._handle_timer(5.)
+        self.assertEqual(calls, [5.])
+        self.assertEqual(deadline.waketime, 5.)
+        self.sim.advance(10.)
+        self.assertEqual(calls, [5.] * 3)
+        self.assertEqual(deadline.waketime, self.sim.reactor.NEVER)
+
+class TestMajorityFilter(unittest.TestCase):
+
+    def make_helper(self, **options):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", **options)
+        self.sim.start()
+        return sensor.runout_helper
+
+    def chatter(self, duration):
+        # Pellet present with short dropouts every 0.2 seconds
+        for i in range(int(duration / 0.2)):
+            self.sim.set_sensor("hopper", True)
+            self.sim.advance(0.18)
+            self.sim.set_sensor("hopper", False)
+            self.sim.advance(0.02)
+        self.sim.set_sensor("hopper", True)
+
+    def test_debounce_never_settles(self):
+        helper = self.make_helper()
+        self.chatter(10.)
+        self.assertIsNone(helper.last_action)
+
+    def test_majority_settles(self):
+        helper = self.make_helper(filter='majority')
+        self.chatter(10.)
+        self.assertEqual(helper.last_action, 'off')
+        self.assertTrue(helper.pellet_present)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(0.5)
+        self.assertEqual(helper.last_action, 'off')
+        self.sim.advance(0.6)
+        self.assertEqual(helper.last_action, 'on')
+        self.assertFalse(helper.pellet_present)
+
+    def test_bit_count(self):
+        helper = self.make_helper(filter='majority', window_samples=8)
+        mfilter = helper.majority_filter
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(2.)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(0.25)
+        self.sim.set_sensor("hopper", True)
+        self.assertEqual(mfilter.history, 0b11111100)
+        self.assertEqual(mfilter.count, bin(mfilter.history).count('1'))
+
+    def test_thresholds(self):
+        self.assertRaises(pellet_sim.SimConfig.error, self.make_helper,
+                          filter='majority', high_threshold=4,
+                          low_threshold=4)
+
+class TestEmergencyWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", emergency_time=5,
+                                     emergency_gcode='M117 empty')
+        self.sim.start()
+        self.runout_helper = sensor.runout_helper
+
+    def test_stuck_empty(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(5.9)
+        self.assertEqual(self.sim.gcode.scripts, [])
+        self.sim.advance(0.2)
+        self.assertEqual(self.sim.gcode.scripts, ["M117 empty\nM400"])
+        self.sim.advance(60.)
+        self.assertEqual(len(self.sim.gcode.scripts), 1)
+
+    def test_filledup_disarms(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(4.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(60.)
+        self.assertEqual(self.runout_helper.last_action, 'off')
+        self.assertEqual(self.sim.gcode.scripts, [])
+
+    def test_no_emergency_gcode(self):
+        sim = pellet_sim.PelletSimulation()
+        runout_helper = sim.add_sensor("hopper").runout_helper
+        sim.start()
+        sim.set_sensor("hopper", False)
+        sim.advance(60.)
+        self.assertEqual(runout_helper.last_action, 'on')
+        self.assertEqual(sim.gcode.scripts, [])
+
+class TestEdgeTimestamps(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", emergency_time=5,
+                                     emergency_gcode='M117 empty',
+                                     trace_level=2)
+        self.sim.start()
+        self.runout_helper = sensor.runout_helper
+
+    def test_late_callback(self):
+        # The host handles the edge 0.3s after the pin changed
+        self.sim.advance(1.3)
+        self.sim.set_sensor("hopper", False, eventtime=1.)
+        self.assertEqual(self.runout_helper.last_state_change_time, 1.)
+        self.sim.advance(0.71)
+        self.assertEqual(self.runout_helper.last_action, 'on')
+        self.assertEqual(self.runout_helper.trace.format(1),
+                         ["2.000 runout state=False"])
+        self.sim.run_until(6.99)
+        self.assertEqual(self.sim.gcode.scripts, [])
+        self.sim.run_until(7.)
+        self.assertEqual(self.sim.gcode.scripts, ["M117 empty\nM400"])
+
+    def test_jitter_does_not_reset_debounce(self):
+        self.sim.set_sensor("hopper", False, eventtime=0.)
+        self.sim.advance(0.5)
+        self.sim.set_sensor("hopper", True, eventtime=0.2)
+        self.sim.advance(0.71)
+        self.assertEqual(self.runout_helper.last_action, 'off')
+
+class TestFeederRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.sim.add_sensor("hopper", runout_gcode='M118 runout')
+        self.sim.start()
+        self.pin = self.sim.get_feeder_pin("hopper")
+
+    def test_relay_commands(self):
+        self.assertEqual(self.pin.max_duration, 0.)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(2.)
+        self.assertEqual(self.pin.commands, [(1.1, 1), (3.1, 0)])
+        self.assertEqual(self.sim.gcode.scripts, ["M118 runout\nM400"])
+
+    def test_redundant_writes(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(0.1)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.pin.commands, [(1.1, 1)])
+
+    def test_repeated_runout(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        # A bounce shorter than debounce_time leads to a second runout
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(0.1)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts, ["M118 runout\nM400"])
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(2.)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.assertEqual(self.sim.gcode.scripts, ["M118 runout\nM400"] * 2)
+
+    def test_repeated_filledup(self):
+        sim = pellet_sim.PelletSimulation()
+        sim.add_sensor("hopper", filledup_gcode='M118 filledup')
+        sim.start()
+        runout_helper = sim.sensors["hopper"].runout_helper
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        # A bounce shorter than debounce_time, with the feeder never on
+        sim.set_sensor("hopper", False)
+        sim.advance(0.1)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        # Print end with the feeder off
+        sim.set_printing(False)
+        sim.advance(1.)
+        self.assertEqual(runout_helper.rate_limiter.switch_count, 0)
+        self.assertEqual(sim.gcode.scripts, [])
+        # A real refill runs it once
+        sim.set_printing(True)
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        self.assertEqual(sim.gcode.scripts, ["M118 filledup\nM400"])
+
+    def test_not_printing(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(2.)
+        self.sim.set_printing(False)
+        self.sim.set_printing(False)
+        self.assertEqual(self.pin.commands, [(1.1, 1), (2.1, 0)])
+
+    def test_no_relay(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", rele_pin=None)
+        sim.start()
+        self.assertIsNone(sensor.runout_helper.feeder_relay)
+
+class TestFeederRateLimiter(unittest.TestCase):
+
+    def make_sim(self, **options):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1, **options)
+        self.sim.start()
+        self.pin = self.sim.get_feeder_pin("hopper")
+        return sensor.runout_helper
+
+    def toggle(self, count, interval):
+        for i in range(count):
+            self.sim.set_sensor("hopper", i % 2)
+            self.sim.advance(interval)
+
+    def test_min_on_off_time(self):
+        helper = self.make_sim(min_on_time=5., min_off_time=3.)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(1.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(1.)
+        # The feeder stays on until min_on_time has elapsed
+        self.assertTrue(helper.get_status(2.)["feeder_on"])
+        self.sim.run_until(5.1)
+        self.assertEqual(helper.last_action, 'off')
+        self.assertEqual([v for t, v in self.pin.commands], [1, 0])
+        self.assertAlmostEqual(self.pin.commands[1][0] - self.pin.commands[0][0],
+                               5.)
+        status = helper.get_status(self.sim.reactor.now)
+        self.assertEqual(status["suppressed_switches"], 1)
+        self.assertEqual(status["feeder_switches"], 2)
+
+    def test_max_switches(self):
+        helper = self.make_sim(max_switches_per_minute=6)
+        self.toggle(60, 1.)
+        times = [t for t, v in self.pin.commands]
+        for i in range(6, len(times)):
+            self.assertGreaterEqual(times[i] - times[i - 6], 60.)
+        self.assertEqual(len(times), 6)
+        self.assertGreater(helper.rate_limiter.suppressed_count, 0)
+
+    def test_unlimited(self):
+        helper = self.make_sim()
+        self.toggle(60, 1.)
+        self.assertEqual(len(self.pin.commands), 60)
+        self.assertEqual(helper.rate_limiter.suppressed_count, 0)
+
+class FakeToolhead:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+    def get_status(self, eventtime):
+        return {'position': list(self.position),
+                'estimated_print_time': eventtime}
+
+class TestCachedTemplate(unittest.TestCase):
+
+    def make_template(self, script):
+        sim = pellet_sim.PelletSimulation()
+        self.toolhead = FakeToolhead()
+        sim.printer.add_object('toolhead', self.toolhead)
+        sensor = sim.add_sensor("hopper", runout_gcode=script)
+        template = sensor.runout_helper.runout_gcode
+        self.renders = 0
+        render = template.template.render
+        def counting_render(context=None):
+            self.renders += 1
+            return render(context)
+        template.template.render = counting_render
+        return template
+
+    def test_static(self):
+        template = self.make_template("M118 runout")
+        self.assertTrue(template.is_static)
+        for i in range(3):
+            script = template.get_script("PAUSE\n", float(i))
+        self.assertEqual(script, "PAUSE\nM118 runout\nM400")
+        self.assertIs(script, template.get_script("PAUSE\n", 4.))
+        self.assertEqual(template.get_script("", 5.), "M118 runout\nM400")
+        self.assertEqual(self.renders, 1)
+
+    def test_dynamic(self):
+        template = self.make_template(
+            "M118 {printer.toolhead.position} {printer['toolhead'].x}")
+        self.assertEqual(template.fields,
+                         [('toolhead', 'position'), ('toolhead', 'x')])
+        # estimated_print_time changes, but the script does not read it
+        template.get_script("", 0.)
+        template.get_script("", 1.)
+        self.assertEqual(self.renders, 1)
+        self.toolhead.position[3] = 10.
+        template.get_script("", 2.)
+        self.assertEqual(self.renders, 2)
+
+    def test_uncacheable(self):
+        for script in ["{action_respond_info('empty')}",
+                       "{% set p = printer %}M118 {p.toolhead}",
+                       "M118 {printer.toolhead}",
+                       "M118 {printer.toolhead.get('position')}"]:
+            template = self.make_template(script)
+            self.assertIsNone(template.fields)
+            template.get_script("", 0.)
+            template.get_script("", 1.)
+            self.assertEqual(self.renders, 2)
+
+    @unittest.skipIf(jinja2 is None, "jinja2 not installed")
+    def test_jinja_template(self):
+        template = self.make_template(
+            "M118 E{printer.toolhead.position[3]|round(1)}")
+        # Rendered by jinja2 from the printer objects, as gcode_macro does
+        env = jinja2.Environment('{%', '%}', '{', '}')
+        jinja_template = env.from_string(template.template.script)
+        printer = template.printer
+        def render(context=None):
+            self.renders += 1
+            status = {name: obj.get_status(0.)
+                      for name, obj in printer.lookup_objects()
+                      if hasattr(obj, 'get_status')}
+            return jinja_template.render(printer=status)
+        template.template.render = render
+        for i in range(5):
+            script = template.get_script("", float(i))
+        self.assertEqual(script, "M118 E0.0\nM400")
+        self.assertEqual(self.renders, 1)
+        self.toolhead.position[3] = 12.34
+        self.assertEqual(template.get_script("", 6.), "M118 E12.3\nM400")
+        self.assertEqual(self.renders, 2)
+
+class TestHopperStats(unittest.TestCase):
+
+    def test_running_stats(self):
+        stats = filament_switch_sensor.RunningStats()
+        for value in [2., 4., 4., 4., 5., 5., 7., 9.]:
+            stats.add(value)
+        status = stats.get_status()
+        self.assertEqual(status["count"], 8)
+        self.assertAlmostEqual(status["mean"], 5.)
+        self.assertAlmostEqual(status["stddev"], math.sqrt(32. / 7.))
+        self.assertEqual((status["min"], status["max"]), (2., 9.))
+
+    def test_refill_cycles(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=0.1)
+        sim.start()
+        helper = sensor.runout_helper
+        for i in range(3):
+            sim.set_sensor("hopper", False)
+            sim.advance(2. + i)
+            sim.set_sensor("hopper", True)
+            sim.advance(5.)
+        stats = helper.get_status(sim.reactor.now)["stats"]
+        self.assertEqual(stats["edge_count"], 6)
+        self.assertEqual(stats["refill_time"]["count"], 3)
+        self.assertAlmostEqual(stats["refill_time"]["mean"], 3.)
+        self.assertAlmostEqual(stats["refill_time"]["min"], 2.)
+        self.assertAlmostEqual(stats["refill_time"]["max"], 4.)
+        self.assertAlmostEqual(stats["empty_time"]["mean"], 3.)
+        self.assertAlmostEqual(stats["feeder_duty_cycle"],
+                               9. / sim.reactor.now)
+        self.assertGreater(stats["edge_rate"], 0.)
+
+    def test_empty_time_debounced(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=0.5)
+        sim.start()
+        helper = sensor.runout_helper
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        # Glitches shorter than debounce_time are not empty periods
+        for i in range(5):
+            sim.set_sensor("hopper", False)
+            sim.advance(0.05)
+            sim.set_sensor("hopper", True)
+            sim.advance(1.)
+        empty_time = helper.get_status(sim.reactor.now)["stats"]["empty_time"]
+        self.assertEqual(empty_time["count"], 0)
+        self.assertEqual(empty_time["min"], None)
+        self.assertEqual(helper.stats.edge_count, 11)
+        # A runout with a bounce in it is one period, timed from its edges
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_sensor("hopper", True)
+        sim.advance(0.1)
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        empty_time = helper.get_status(sim.reactor.now)["stats"]["empty_time"]
+        self.assertEqual(empty_time["count"], 1)
+        self.assertAlmostEqual(empty_time["mean"], 4.1)
+        # The end of a print with the hopper empty ends no period
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_printing(False)
+        sim.set_sensor("hopper", True)
+        sim.advance(10.)
+        sim.set_printing(True)
+        sim.set_sensor("hopper", False)
+        sim.advance(2.)
+        sim.set_sensor("hopper", True)
+        sim.advance(2.)
+        empty_time = helper.stats.empty_time
+        self.assertEqual(empty_time.count, 2)
+        self.assertAlmostEqual(empty_time.max, 4.1)
+        self.assertAlmostEqual(empty_time.min, 2.)
+
+class TestStatusCache(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.sim.add_sensor("hopper0", debounce_time=0.1)
+        self.sim.add_sensor("hopper1", debounce_time=0.1)
+        self.sim.start()
+        self.helper = self.sim.printer.lookup_object(
+            "filament_switch_sensor hopper0").runout_helper
+        self.manager = self.helper.manager
+
+    def test_unchanged(self):
+        now = self.sim.reactor.now
+        status = self.helper.get_status(now)
+        manager_status = self.manager.get_status(now)
+        self.assertIs(self.helper.get_status(now + 0.5), status)
+        self.assertIs(self.manager.get_status(now + 0.5), manager_status)
+        self.assertIs(manager_status["sensors"]["hopper0"], status)
+
+    def test_version(self):
+        status = self.helper.get_status(self.sim.reactor.now)
+        version = status["version"]
+        self.sim.set_sensor("hopper0", False)
+        self.sim.advance(0.5)
+        new_status = self.helper.get_status(self.sim.reactor.now)
+        self.assertGreater(new_status["version"], version)
+        self.assertTrue(new_status["feeder_on"])
+        # The published dict is left untouched
+        self.assertFalse(status["feeder_on"])
+        manager_status = self.manager.get_status(self.sim.reactor.now)
+        self.assertEqual(manager_status["feeding"], ["hopper0"])
+        self.assertEqual(manager_status["empty"], ["hopper0"])
+
+    def test_refresh(self):
+        self.sim.set_sensor("hopper0", False)
+        self.sim.advance(0.5)
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.sim.advance(2.)
+        new_status = self.helper.get_status(self.sim.reactor.now)
+        self.assertIsNot(new_status, status)
+        self.assertGreater(new_status["stats"]["feeder_duty_cycle"],
+                           status["stats"]["feeder_duty_cycle"])
+
+class TestPelletHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1,
+                                     history_size=4)
+        self.sim.start()
+        self.helper = sensor.runout_helper
+
+    def test_records(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(1.)
+        records = self.helper.history.get_records()
+        self.assertEqual([(name, state) for t, name, state in records],
+                         [("state", False), ("runout", False)])
+        self.assertAlmostEqual(records[1][0] - records[0][0], 0.1)
+
+    def test_wraparound(self):
+        for i in range(4):
+            self.sim.set_sensor("hopper", i % 2)
+            self.sim.advance(1.)
+        records = self.helper.history.get_records()
+        self.assertEqual(len(records), 4)
+        self.assertEqual([name for t, name, state in records],
+                         ["state", "runout", "state", "filledup"])
+        self.assertEqual(len(self.helper.history.get_records(2)), 2)
+
+    def test_query_command(self):
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(1.)
+        self.sim.run_command("QUERY_PELLET_HISTORY SENSOR=hopper COUNT=1")
+        response = self.sim.gcode.responses[-1]
+        self.assertIn("hopper history (1 of 2 events)", response)
+        self.assertIn("runout state=False", response)
+
+class TestRunoutPause(unittest.TestCase):
+
+    def test_pause_does_not_block(self):
+        sim = pellet_sim.PelletSimulation()
+        sim.add_sensor("hopper0", debounce_time=0.1, pause_on_runout=True,
+                       runout_gcode="M118 runout")
+        sim.add_sensor("hopper1", debounce_time=0.1)
+        sim.start()
+        pause_resume = sim.printer.lookup_object('pause_resume')
+        sim.set_sensor("hopper0", False)
+        sim.advance(0.2)
+        self.assertEqual(pause_resume.pause_count, 1)
+        self.assertEqual(sim.gcode.scripts, [])
+        # The other hopper keeps being served while the pause lands
+        start = sim.reactor.now
+        sim.set_sensor("hopper1", False)
+        sim.advance(0.15)
+        self.assertEqual(sim.get_feeder_pin("hopper1").commands[-1][1], 1)
+        self.assertLess(sim.reactor.now - start, 0.5)
+        self.assertEqual(sim.gcode.scripts, [])
+        sim.advance(0.5)
+        self.assertEqual(sim.gcode.scripts, ["PAUSE\nM118 runout\nM400"])
+
+class TestEdgeStorm(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1,
+                                     storm_rate=50)
+        self.sim.start()
+        self.helper = sensor.runout_helper
+
+    def chatter(self, count, interval, last_state):
+        for i in range(count):
+            self.sim.set_sensor("hopper", (i + last_state + 1) % 2)
+            self.sim.advance(interval)
+
+    def test_storm(self):
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(2.)
+        # 200 edges per second, ending with an empty hopper
+        self.chatter(400, 0.005, 0)
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.assertTrue(status["sensor_fault"])
+        self.assertLess(status["stats"]["edge_count"], 60)
+        self.assertEqual(len(self.sim.gcode.responses), 1)
+        self.assertIn("edges are coalesced", self.sim.gcode.responses[0])
+        # The pending sample is handled once the storm ends
+        self.sim.advance(2.5)
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.assertFalse(status["sensor_fault"])
+        self.assertFalse(status["filament_detected"])
+        self.assertEqual(self.helper.last_action, 'on')
+        self.assertEqual(self.helper.storm_filter.storm_count, 1)
+
+    def test_one_shot_warning(self):
+        for i in range(3):
+            self.chatter(200, 0.005, 1)
+            self.sim.advance(3.)
+        self.assertEqual(self.helper.storm_filter.storm_count, 3)
+        self.assertEqual(len(self.sim.gcode.responses), 1)
+
+    def test_below_rate(self):
+        self.chatter(40, 0.03, 1)
+        self.sim.advance(1.)
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.assertFalse(status["sensor_fault"])
+        self.assertEqual(status["stats"]["edge_count"], 40)
+
+class TestPredictiveFeeding(unittest.TestCase):
+
+    def run_hopper(self, predictive, warmup=150., duration=150.,
+                   glitches=False):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.5,
+                                     predictive=predictive)
+        self.sim.start()
+        self.helper = sensor.runout_helper
+        self.hopper = self.sim.add_hopper("hopper", level=60., threshold=50.,
+                                          fill_rate=20., feed_delay=3.)
+        if glitches:
+            self.sim.reactor.register_timer(self.glitch, 3.)
+        self.sim.set_extrude_rate(12.)
+        self.sim.advance(warmup)
+        self.hopper.min_level = self.hopper.level
+        trips = self.helper.stats.empty_time.count
+        self.sim.advance(duration)
+        return self.helper.stats.empty_time.count - trips
+
+    def test_reactive(self):
+        trips = self.run_hopper(False)
+        self.assertGreater(trips, 5)
+        self.assertLess(self.hopper.min_level, 20.)
+
+    def test_predictive(self):
+        trips = self.run_hopper(True)
+        self.assertEqual(trips, 0)
+        self.assertGreater(self.hopper.min_level, 50.)
+        self.assertLess(self.hopper.max_level, 100.)
+        prediction = self.helper.get_status(
+            self.sim.reactor.now)["prediction"]
+        self.assertAlmostEqual(prediction["consumption_rate"], 12.)
+        self.assertAlmostEqual(prediction["fill_rate"], 20., delta=1.)
+
+    def glitch(self, eventtime):
+        # The sensor reads empty until the next hopper step (50ms)
+        if self.hopper.level > 58.:
+            self.sim.set_sensor("hopper", False)
+            self.glitch_count += 1
+        return eventtime + 3.
+
+    def test_glitches(self):
+        self.glitch_count = 0
+        trips = self.run_hopper(True, glitches=True)
+        self.assertGreater(self.glitch_count, 20)
+        self.assertEqual(trips, 0)
+        self.assertGreater(self.hopper.min_level, 50.)
+        prediction = self.helper.get_status(
+            self.sim.reactor.now)["prediction"]
+        self.assertGreater(prediction["buffer"], 45.)
+
+    def test_feeder_off_without_refill(self):
+        sim = pellet_sim.PelletSimulation()
+        config = pellet_sim.SimConfig(sim.printer, "predictor", {})
+        predictor = filament_switch_sensor.FeederPredictor(config)
+        predictor.sample(0., 0.)
+        predictor.note_feeder_on(0.)
+        predictor.sample(5., 10.)
+        predictor.note_feeder_off(5., True)
+        predictor.sample(10., 20.)
+        # A filledup with the feeder off leaves the learned state alone
+        predictor.note_feeder_off(10., True)
+        self.assertEqual(predictor.full_e, 10.)
+        self.assertEqual(predictor.filledup_e, 10.)
+        self.assertEqual(predictor.get_used(), 10.)
+
+    def test_not_printing(self):
+        self.run_hopper(True, duration=0.)
+        while not self.helper.predictor.prefeed_end:
+            self.sim.advance(0.1)
+        self.sim.set_printing(False)
+        self.assertFalse(self.helper.rate_limiter.feeder_on)
+        self.assertIsNone(self.helper.predictor.prefeed_end)
+        self.assertEqual(self.sim.get_feeder_pin("hopper").commands[-1][1], 0)
+
+    def test_retractions(self):
+        sim = pellet_sim.PelletSimulation()
+        config = pellet_sim.SimConfig(sim.printer, "predictor", {})
+        predictor = filament_switch_sensor.FeederPredictor(config)
+        predictor.sample(0., 10.)
+        for i in range(100):
+            predictor.sample(i + .5, 9.)
+            predictor.sample(i + 1., 10.)
+        self.assertEqual(predictor.e_total, 0.)
+        self.assertAlmostEqual(predictor.rate, 0.)
+        predictor.sample(101., 12.)
+        self.assertEqual(predictor.e_total, 2.)
+
+    def test_requires_relay(self):
+        sim = pellet_sim.PelletSimulation()
+        with self.assertRaises(sim.printer.config_error):
+            sim.add_sensor("hopper", predictive=True, rele_pin=None)
+
+class TestRunoutEscalation(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.sim.printer.lookup_object('gcode_move').speed_factor = 1.2
+        sensor = self.sim.add_sensor(
+            "hopper", debounce_time=0.1, pause_on_runout=True,
+            escalation=True, escalation_throttle_step=20,
+            escalation_min_speed=50, escalation_pause_time=30)
+        self.sim.start()
+        self.helper = sensor.runout_helper
+        self.pause_resume = self.sim.printer.lookup_object('pause_resume')
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(1.)
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(0.2)
+
+    def get_stage(self):
+        return self.helper.get_status(self.sim.reactor.now)["escalation"]
+
+    def speed_scripts(self):
+        return [s for s in self.sim.gcode.scripts if s.startswith("M220")]
+
+    def test_stages(self):
+        self.assertEqual(self.get_stage(), "runout")
+        self.assertEqual(self.pause_resume.pause_count, 0)
+        self.sim.advance(5.)
+        self.assertEqual(self.get_stage(), "warn")
+        self.assertEqual(len(self.sim.gcode.responses), 1)
+        self.sim.advance(5.)
+        self.assertEqual(self.get_stage(), "throttle")
+        self.assertEqual(self.speed_scripts(), ["M220 S96"])
+        self.sim.advance(15.)
+        # Never below escalation_min_speed of the original speed
+        self.assertEqual(self.speed_scripts(),
+                         ["M220 S96", "M220 S72", "M220 S60"])
+        self.assertEqual(self.pause_resume.pause_count, 0)
+        self.sim.advance(6.)
+        self.assertEqual(self.get_stage(), "pause")
+        self.assertEqual(self.pause_resume.pause_count, 1)
+        self.assertEqual(self.sim.gcode.scripts[-1], "PAUSE")
+
+    def test_filledup_restores_speed(self):
+        self.sim.advance(16.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(0.2)
+        self.assertEqual(self.get_stage(), "none")
+        self.assertEqual(self.speed_scripts(),
+                         ["M220 S96", "M220 S72", "M220 S120"])
+        self.sim.advance(60.)
+        self.assertEqual(self.pause_resume.pause_count, 0)
+
+    def test_short_runout(self):
+        self.sim.advance(2.)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(60.)
+        self.assertEqual(self.sim.gcode.responses, [])
+        self.assertEqual(self.speed_scripts(), [])
+        self.assertEqual(self.pause_resume.pause_count, 0)
+
+    def test_not_printing(self):
+        self.sim.advance(12.)
+        self.sim.set_printing(False)
+        self.sim.advance(0.1)
+        self.assertEqual(self.get_stage(), "none")
+        self.assertEqual(self.speed_scripts()[-1], "M220 S120")
+
+    def test_rounding(self):
+        # (start + warn_time) - start < warn_time for this start time
+        sim = pellet_sim.PelletSimulation(start_time=4.588033228812184)
+        sensor = sim.add_sensor("hopper", escalation=True)
+        sim.start()
+        helper = sensor.runout_helper
+        start_time = 5.588033228812184
+        self.assertLess((start_time + 5.) - start_time, 5.)
+        helper.runout(start_time)
+        sim.advance(10.)
+        self.assertEqual(helper.escalation.get_stage(), "warn")
+        sim.advance(2.)
+        self.assertEqual(helper.escalation.get_stage(), "throttle")
+        self.assertEqual(helper.escalation.steps, 1)
+        self.assertEqual(len(sim.gcode.responses), 1)
+
+class TestPulsedFeeder(unittest.TestCase):
+
+    def run_hopper(self, feeder_mode, warmup=300., duration=300.):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.5,
+                                     feeder_mode=feeder_mode)
+        self.sim.start()
+        self.helper = sensor.runout_helper
+        self.hopper = self.sim.add_hopper("hopper", level=60., threshold=50.,
+                                          fill_rate=10., feed_delay=2.)
+        self.sim.set_extrude_rate(2.)
+        self.sim.advance(warmup)
+        self.hopper.min_level = self.hopper.max_level = self.hopper.level
+        self.sim.advance(duration)
+
+    def test_pulses(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1,
+                                     feeder_mode="pulsed", pulse_period=2.,
+                                     pulse_duty=0.25)
+        self.sim.start()
+        pin = self.sim.get_feeder_pin("hopper")
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(0.15)
+        # The whole pulse is queued at once
+        self.assertEqual(len(pin.commands), 2)
+        (on_time, on), (off_time, off) = pin.commands
+        self.assertEqual((on, off), (1, 0))
+        self.assertAlmostEqual(off_time - on_time, 0.5)
+        self.assertGreater(off_time, self.sim.reactor.now)
+        self.sim.advance(4.)
+        self.assertEqual([v for t, v in pin.commands], [1, 0] * 3)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(10.)
+        self.assertEqual(len(pin.commands), 6)
+        status = sensor.runout_helper.get_status(self.sim.reactor.now)
+        self.assertEqual(status["pulse"]["pulses"], 3)
+        self.assertLess(status["pulse"]["duty"], 0.25)
+
+    def test_slow_refill(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1,
+                                     feeder_mode="pulsed", pulse_duty=0.5,
+                                     pulse_refill_time=10.)
+        self.sim.start()
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(35.)
+        self.assertAlmostEqual(sensor.runout_helper.pulser.duty, 1.)
+        self.assertEqual(self.sim.get_feeder_pin("hopper").commands[-1][1], 1)
+        self.sim.set_sensor("hopper", True)
+        self.sim.advance(0.2)
+        self.assertEqual(self.sim.get_feeder_pin("hopper").commands[-1][1], 0)
+
+    def test_high_duty(self):
+        for duty in (0.9, 0.97):
+            sim = pellet_sim.PelletSimulation()
+            sim.add_sensor("hopper", debounce_time=0.1, feeder_mode="pulsed",
+                           pulse_period=2., pulse_duty=duty,
+                           pulse_refill_time=1000.)
+            sim.start()
+            pin = sim.get_feeder_pin("hopper")
+            sim.set_sensor("hopper", False)
+            for i in range(100):
+                sim.advance(1.)
+                # The queued commands never drift ahead of the host
+                self.assertLess(pin.commands[-1][0] - sim.reactor.now, 2.)
+            if duty > 0.9:
+                self.assertEqual(pin.commands, [(pin.commands[0][0], 1)])
+
+    def test_disable(self):
+        self.sim = pellet_sim.PelletSimulation()
+        sensor = self.sim.add_sensor("hopper", debounce_time=0.1,
+                                     feeder_mode="pulsed", pulse_duty=0.5,
+                                     pulse_refill_time=5.)
+        self.sim.start()
+        pulser = sensor.runout_helper.pulser
+        pin = self.sim.get_feeder_pin("hopper")
+        self.sim.set_sensor("hopper", False)
+        self.sim.advance(1.)
+        self.sim.run_command("SET_FILAMENT_SENSOR SENSOR=hopper ENABLE=0")
+        count = len(pin.commands)
+        self.sim.advance(60.)
+        self.assertEqual(len(pin.commands), count)
+        self.assertEqual(pin.commands[-1][1], 0)
+        self.assertEqual(pulser.duty, 0.5)
+        self.sim.run_command("SET_FILAMENT_SENSOR SENSOR=hopper ENABLE=1")
+        self.sim.advance(1.)
+        self.assertEqual(len(pin.commands), count + 2)
+
+    def test_overfill(self):
+        self.run_hopper("continuous")
+        continuous_max = self.hopper.max_level
+        self.run_hopper("pulsed")
+        self.assertEqual(self.hopper.starved_time, 0.)
+        self.assertLess(self.hopper.max_level - 50.,
+                        (continuous_max - 50.) / 2.)
+
+    def test_config(self):
+        sim = pellet_sim.PelletSimulation()
+        with self.assertRaises(sim.printer.config_error):
+            sim.add_sensor("hopper0", feeder_mode="pulsed", rele_pin=None)
+        with self.assertRaises(sim.printer.config_error):
+            sim.add_sensor("hopper1", feeder_mode="pulsed", predictive=True)
+
+class TestLevelSensor(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = pellet_sim.PelletSimulation()
+        self.sensor = self.sim.add_level_sensor(
+            "hopper", debounce_time=0.1, level_empty_value=0.9,
+            level_full_value=0.1, level_smooth_time=0., low_level=20.,
+            high_level=80.)
+        self.sim.set_level("hopper", 0.5)
+        self.sim.start()
+        self.helper = self.sensor.runout_helper
+        self.pin = self.sim.get_feeder_pin("hopper")
+        self.sim.advance(1.)
+
+    def set_level(self, level, delay=1.):
+        self.sim.set_level("hopper", 0.9 - 0.8 * level / 100.)
+        self.sim.advance(delay)
+
+    def test_filter(self):
+        config = pellet_sim.SimConfig(self.sim.printer, "filter", {
+            'level_median_samples': 3, 'level_smooth_time': 1.})
+        level_filter = filament_switch_sensor.LevelFilter(config)
+        self.assertEqual(level_filter.update(0., 10.), 10.)
+        self.assertEqual(level_filter.update(1., 10.), 10.)
+        # An isolated spike is dropped by the median
+        self.assertEqual(level_filter.update(2., 100.), 10.)
+        self.assertEqual(level_filter.update(3., 20.), 15.)
+
+    def test_thresholds(self):
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.assertTrue(status["filament_detected"])
+        self.assertAlmostEqual(status["fill_level"], 50.)
+        self.set_level(15.)
+        self.assertEqual(self.pin.commands[-1][1], 1)
+        # Still feeding between the two thresholds
+        self.set_level(60.)
+        self.assertEqual(self.pin.commands[-1][1], 1)
+        status = self.helper.get_status(self.sim.reactor.now)
+        self.assertFalse(status["filament_detected"])
+        self.assertAlmostEqual(status["fill_level"], 60.)
+        self.set_level(85.)
+        self.assertEqual(self.pin.commands[-1][1], 0)
+        self.set_level(30.)
+        self.assertEqual(self.pin.commands[-1][1], 0)
+
+    def test_spike(self):
+        self.sim.set_level("hopper", 0.9)
+        self.sim.advance(0.15)
+        self.set_level(50.)
+        self.assertEqual(self.pin.commands, [])
+        self.assertEqual(self.helper.stats.empty_time.count, 0)
+
+    def test_hopper(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_level_sensor("hopper", debounce_time=0.1)
+        sim.start()
+        hopper = sim.add_hopper("hopper", level=50., fill_rate=10.)
+        sim.set_extrude_rate(4.)
+        sim.advance(200.)
+        # The filter lag adds a few percent past each threshold
+        self.assertGreater(hopper.min_level, 10.)
+        self.assertLess(hopper.max_level, 90.)
+        self.assertGreater(sensor.runout_helper.rate_limiter.switch_count, 4)
+
+    def test_query_adc(self):
+        query_adc = self.sim.printer.lookup_object('query_adc')
+        self.assertIn("filament_switch_sensor hopper", query_adc.adc)
+
+class TestDebounceAutotune(unittest.TestCase):
+
+    def make_tuner(self, **options):
+        sim = pellet_sim.PelletSimulation()
+        config = pellet_sim.SimConfig(sim.printer, "tuner", options)
+        return filament_switch_sensor.DebounceTuner(config)
+
+    def bounce(self, tuner, eventtime, count, interval):
+        for i in range(count):
+            tuner.note_edge(eventtime)
+            eventtime += interval
+        return eventtime
+
+    def test_tune(self):
+        tuner = self.make_tuner()
+        eventtime = self.bounce(tuner, 0., 101, 0.02)
+        eventtime = self.bounce(tuner, eventtime + 60., 21, 0.2)
+        tuner.note_edge(3600.)
+        self.assertEqual(tuner.bounce_count, 120)
+        debounce_time, rate = tuner.tune(3600.)
+        self.assertGreater(debounce_time, 0.2)
+        self.assertLess(debounce_time, 0.23)
+        self.assertEqual(rate, 0.)
+        # Accepting the slower bounces gives a faster window
+        tuner.target_rate = 20.
+        debounce_time, rate = tuner.tune(3600.)
+        self.assertGreater(debounce_time, 0.02)
+        self.assertLessEqual(debounce_time, 0.2)
+        self.assertAlmostEqual(rate, 20.)
+
+    def test_not_enough_data(self):
+        tuner = self.make_tuner()
+        self.assertIsNone(tuner.tune(0.))
+        # Clean edges are no evidence for a shorter window
+        self.bounce(tuner, 0., 10, 5.)
+        self.assertIsNone(tuner.tune(3600.))
+        self.bounce(tuner, 100., 20, 0.2)
+        self.assertEqual(tuner.bounce_count, 19)
+        self.assertIsNone(tuner.tune(3600.))
+        tuner.note_edge(104.)
+        self.assertIsNone(tuner.tune(500.))
+        self.assertIsNotNone(tuner.tune(600.))
+
+    def test_command(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=1., autotune=True)
+        sim.start()
+        helper = sensor.runout_helper
+        for i in range(40):
+            sim.set_sensor("hopper", i % 2)
+            sim.advance(0.3)
+        sim.advance(3600.)
+        sim.run_command("PELLET_SENSOR_AUTOTUNE SENSOR=hopper")
+        self.assertIn("39 bounces", sim.gcode.responses[-1])
+        self.assertEqual(helper.debounce_time, 1.)
+        # The pending check follows the applied window
+        sim.set_sensor("hopper", False)
+        sim.run_command("PELLET_SENSOR_AUTOTUNE SENSOR=hopper APPLY=1")
+        self.assertGreater(helper.debounce_time, 0.3)
+        self.assertLess(helper.debounce_time, 0.35)
+        status = helper.get_status(sim.reactor.now)
+        self.assertEqual(status["debounce_time"], helper.debounce_time)
+        sim.advance(0.4)
+        self.assertEqual(sim.get_feeder_pin("hopper").commands[-1][1], 1)
+
+    def test_command_without_data(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=1., autotune=True)
+        sim.start()
+        sim.advance(3600.)
+        sim.run_command("PELLET_SENSOR_AUTOTUNE SENSOR=hopper APPLY=1")
+        self.assertIn("not enough data", sim.gcode.responses[-1])
+        self.assertEqual(sensor.runout_helper.debounce_time, 1.)
+
+    def test_interval(self):
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=1., autotune=True,
+                                autotune_interval=60.)
+        sim.start()
+        helper = sensor.runout_helper
+        sim.set_sensor("hopper", True)
+        sim.advance(30.)
+        sim.set_sensor("hopper", False)
+        sim.advance(700.)
+        self.assertEqual(helper.debounce_time, 1.)
+        for i in range(30):
+            sim.set_sensor("hopper", i % 2)
+            sim.advance(0.3)
+        self.assertEqual(helper.debounce_time, 1.)
+        sim.advance(60.)
+        self.assertGreater(helper.debounce_time, 0.3)
+        self.assertLess(helper.debounce_time, 0.35)
+
+    def test_majority(self):
+        sim = pellet_sim.PelletSimulation()
+        with self.assertRaises(sim.printer.config_error):
+            sim.add_sensor("hopper", autotune=True, filter="majority")
+
+class TestSimulation(unittest.TestCase):
+
+    def test_long_replay(self):
+        # A day of hopper cycles runs in virtual time
+        sim = pellet_sim.PelletSimulation()
+        sensor = sim.add_sensor("hopper", debounce_time=0.5)
+        sim.start()
+        edges = []
+        for cycle in range(2000):
+            start = cycle * 40.
+            edges.append((start, True))
+            for bounce in range(5):
+                edges.append((start + 30. + bounce * 0.05, bounce % 2 == 1))
+        runouts = []
+        helper = sensor.runout_helper
+        runout = helper.runout
+        def counting_runout(eventtime=None):
+            runouts.append(eventtime)
+            runout(eventtime)
+        helper.runout = counting_runout
+        sim.replay("hopper", edges)
+        sim.advance(10.)
+        self.assertEqual(len(runouts), 2000)
+        self.assertAlmostEqual(runouts[0], 30.7)
 
 if __name__ == '__main__':
     unittest.main()
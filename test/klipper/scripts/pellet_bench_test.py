@@ -0,0 +1,28 @@
+import unittest
+import os
+import sys
+
+# Aggiungi la cartella degli script alla sys.path
+scripts_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../klipper/scripts"))
+sys.path.insert(0, scripts_path)
+
+import pellet_bench
+
+class TestPelletBench(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        results = pellet_bench.run_benchmark((1, 8), 400)
+        self.assertEqual([(r['scenario'], r['sensors']) for r in results],
+                         [('clean', 1), ('clean', 8),
+                          ('chatter', 1), ('chatter', 8)])
+        for res in results:
+            self.assertEqual(res['edges'], 400)
+            self.assertEqual(res['timers'], 1)
+            self.assertLessEqual(res['p50'], res['p99'])
+            self.assertGreater(res['edges_per_sec'], 0.)
+        # Chattering edges never settle, so no deadline fires per edge
+        self.assertLess(results[2]['wakeups_per_edge'], 0.1)
+        self.assertIn("chatter", pellet_bench.format_results(results))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import os
+import sys
+import tempfile
+
+# Aggiungi la cartella degli script alla sys.path
+scripts_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../klipper/scripts"))
+sys.path.insert(0, scripts_path)
+
+import pellet_replay
+
+# Three refills, each with a short bounce after the hopper empties
+EDGES = [(100., False), (100.08, True), (100.15, False), (104., True),
+         (120., False), (120.05, True), (120.1, False), (123., True),
+         (140., False), (143., True)]
+
+class TestPelletReplay(unittest.TestCase):
+
+    def test_replay(self):
+        res = pellet_replay.replay(EDGES, 0.5, 10.)
+        self.assertEqual(res['runouts'], 3)
+        self.assertEqual(res['switches'], 6)
+        self.assertEqual(res['missed_runouts'], 0)
+        self.assertEqual(res['emergencies'], 0)
+        # The bounces reset the debounce, so the feeder is on ~3s
+        self.assertAlmostEqual(res['refill_mean'], (3.85 + 2.9 + 3.) / 3.,
+                               places=2)
+
+    def test_bounces(self):
+        res = pellet_replay.replay(EDGES, 0.02, 2.)
+        self.assertGreater(res['switches'], 6)
+        self.assertEqual(res['emergencies'], 3)
+
+    def test_missed_runouts(self):
+        self.assertEqual(pellet_replay.find_missed_runouts(
+            EDGES, [(103.5, 1), (104.5, 0)], 1.), 2)
+
+    def test_sweep(self):
+        results = pellet_replay.sweep(EDGES, [0.02, 0.5], [2., 10.],
+                                      processes=2)
+        self.assertEqual([(r['debounce_time'], r['emergency_time'])
+                          for r in results],
+                         [(0.02, 2.), (0.02, 10.), (0.5, 2.), (0.5, 10.)])
+        self.assertEqual(results[3], pellet_replay.replay(EDGES, 0.5, 10.))
+        self.assertIn("missed", pellet_replay.format_results(results))
+
+    def test_load_text(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.txt")
+            with open(path, "w") as f:
+                f.write("# time state\n1.5 0\n0.5 1\n\n2.5, 1\n")
+            edges = pellet_replay.load_edges(path)
+        self.assertEqual(edges, [(0.5, True), (1.5, False), (2.5, True)])
+
+    def test_load_sessions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.txt")
+            with open(path, "w") as f:
+                f.write("100 0\n103 1\nsession\n5 0\n2 1\n")
+            sessions = pellet_replay.load_sessions(path)
+            edges = pellet_replay.load_edges(path)
+        self.assertEqual(sessions, [[(100., False), (103., True)],
+                                    [(2., True), (5., False)]])
+        # Time never goes backwards across the restart
+        self.assertEqual(edges, [(100., False), (103., True),
+                                 (163., True), (166., False)])
+
+    def test_load_telemetry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pellet.bin")
+            for names in (["hopper0", "hopper1"], ["hopper1", "hopper0"]):
+                sim = pellet_replay.pellet_sim.PelletSimulation()
+                for name in names:
+                    sim.add_sensor(name, telemetry_file=path)
+                sim.start()
+                sim.advance(10.)
+                for state in (False, True):
+                    sim.set_sensor("hopper0", state)
+                    sim.advance(5.)
+                sim.printer.send_event("klippy:disconnect")
+            sessions = pellet_replay.load_sessions(path, "hopper0")
+            edges = pellet_replay.load_edges(path, "hopper0")
+        self.assertEqual(sessions, [[(10., False), (15., True)]] * 2)
+        times = [t for t, state in edges]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(edges), 4)
+
+    def test_load_telemetry_sensor(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pellet.bin")
+            sim = pellet_replay.pellet_sim.PelletSimulation()
+            for name in ("hopper0", "hopper1"):
+                sim.add_sensor(name, telemetry_file=path)
+            sim.start()
+            sim.advance(10.)
+            sim.set_sensor("hopper0", False)
+            sim.set_sensor("hopper1", True)
+            sim.advance(5.)
+            sim.printer.send_event("klippy:disconnect")
+            # The edges of two sensors are never merged into one stream
+            with self.assertRaises(ValueError):
+                pellet_replay.load_sessions(path)
+            edges = pellet_replay.load_edges(path, "hopper1")
+            self.assertEqual(edges, [(10., True)])
+            # A log of a single sensor needs no name
+            path = os.path.join(tmpdir, "single.bin")
+            sim = pellet_replay.pellet_sim.PelletSimulation()
+            sim.add_sensor("hopper0", telemetry_file=path)
+            sim.start()
+            sim.advance(10.)
+            sim.set_sensor("hopper0", False)
+            sim.advance(5.)
+            sim.printer.send_event("klippy:disconnect")
+            edges = pellet_replay.load_edges(path)
+        self.assertEqual(edges, [(10., False)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+# Aggiungi la cartella degli script alla sys.path
+scripts_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../klipper/scripts"))
+sys.path.insert(0, scripts_path)
+
+import pellet_sim
+import pellet_telemetry
+import filament_switch_sensor
+
+class TestPelletTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "pellet.bin")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_sim(self, names=("hopper0", "hopper1"), toggled=None,
+                disconnect=True):
+        sim = pellet_sim.PelletSimulation()
+        for name in names:
+            sim.add_sensor(name, debounce_time=0.1,
+                           telemetry_file=self.filename)
+        sim.start()
+        for i in range(10):
+            name = toggled or "hopper%d" % (i % 2,)
+            sim.set_sensor(name, (i // 2) % 2)
+            sim.advance(1.)
+        if disconnect:
+            sim.printer.send_event("klippy:disconnect")
+        return sim
+
+    def test_records(self):
+        self.run_sim()
+        with pellet_telemetry.TelemetryLog(self.filename) as log:
+            self.assertEqual(log.sensor_names, ["hopper0", "hopper1"])
+            records = list(log.iter_records())
+            self.assertEqual(log.count, len(records))
+            columns = log.get_columns()
+        self.assertEqual(len(columns['time']), len(records))
+        self.assertEqual(list(columns['session']), [0] * len(records))
+        names = [pellet_telemetry.DECISION_NAMES[r[3]] for r in records]
+        self.assertEqual(names.count("edge"), 10)
+        self.assertEqual(names.count("runout"), names.count("filledup") + 2)
+        times = [r[0] for r in records]
+        self.assertEqual(times, sorted(times))
+
+    def test_append(self):
+        self.run_sim()
+        size = os.path.getsize(self.filename)
+        self.run_sim()
+        self.assertEqual(os.path.getsize(self.filename), 2 * size)
+        with pellet_telemetry.TelemetryLog(self.filename) as log:
+            lines = pellet_telemetry.summarize(log)
+            self.assertIn("hopper0: ", "\n".join(lines))
+            self.assertEqual(len(pellet_telemetry.dump(log, 3)), 3)
+
+    def test_sessions(self):
+        # The sensor ids change between the two sessions
+        self.run_sim(["hopper0", "hopper1"], "hopper0")
+        self.run_sim(["hopper1", "hopper0"], "hopper0")
+        with pellet_telemetry.TelemetryLog(self.filename) as log:
+            self.assertEqual(len(log.sessions), 2)
+            self.assertEqual(log.sensor_names, ["hopper1", "hopper0"])
+            edges = [(session, name) for session, t, name, state, decision
+                     in log.iter_named_records()
+                     if decision == filament_switch_sensor.TELEMETRY_EDGE]
+            self.assertEqual(set(edges), {(0, "hopper0"), (1, "hopper0")})
+            summary = "\n".join(pellet_telemetry.summarize(log))
+        self.assertIn("in 2 sessions", summary)
+        self.assertIn("hopper0: ", summary)
+        self.assertNotIn("hopper1", summary)
+
+    def test_legacy_sensors_file(self):
+        self.run_sim()
+        with open(self.filename + ".sensors", "w") as f:
+            f.write("hopper0\nhopper1\n")
+        with pellet_telemetry.TelemetryLog(self.filename) as log:
+            self.assertEqual(log.sessions, [(0, ["hopper0", "hopper1"])])
+
+    def get_telemetry(self, sim):
+        manager = sim.printer.lookup_object('pellet_sensors')
+        return list(manager.telemetry.values())[0]
+
+    def test_open_error(self):
+        self.filename = os.path.join(self.tmpdir.name, "missing", "pellet.bin")
+        with self.assertLogs(level='ERROR') as logs:
+            sim = self.run_sim(disconnect=False)
+        telemetry = self.get_telemetry(sim)
+        self.assertTrue(telemetry.failed)
+        self.assertIsNone(telemetry.thread)
+        self.assertEqual(len(telemetry.buffer), 0)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(telemetry.flush_timer.waketime, sim.reactor.NEVER)
+        sim.printer.send_event("klippy:disconnect")
+
+    def test_write_error(self):
+        with mock.patch('os.write', side_effect=OSError("disk full")):
+            with self.assertLogs(level='ERROR') as logs:
+                sim = self.run_sim(disconnect=False)
+                telemetry = self.get_telemetry(sim)
+                # Let the writer thread see the first write error
+                for i in range(100):
+                    if telemetry.failed:
+                        break
+                    time.sleep(0.01)
+                sim.advance(5.)
+                self.assertTrue(telemetry.failed)
+                self.assertEqual(len(telemetry.buffer), 0)
+                sim.printer.send_event("klippy:disconnect")
+        self.assertIsNone(telemetry.thread)
+        self.assertTrue(telemetry.queue.empty())
+        self.assertEqual(len(logs.records), 1)
+
+    @unittest.skipIf(pellet_telemetry.numpy is None, "numpy not installed")
+    def test_numpy(self):
+        self.run_sim()
+        self.run_sim()
+        with pellet_telemetry.TelemetryLog(self.filename) as log:
+            records = log.get_numpy()
+            columns = log.get_columns()
+            expected = list(log.iter_records())
+        # Both outlive the log
+        self.assertEqual(len(records), len(expected))
+        self.assertEqual(records['time'].tolist(), [r[0] for r in expected])
+        self.assertEqual(columns['decision'].tolist(),
+                         [r[3] for r in expected])
+        half = len(expected) // 2
+        self.assertEqual(columns['session'].tolist(),
+                         [0] * half + [1] * half)
+
+if __name__ == '__main__':
+    unittest.main()